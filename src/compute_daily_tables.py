@@ -0,0 +1,435 @@
+"""
+Script that computes and stores the mitma_trips, mitma_trips_matrix,
+mitma_qrp and mitma_flux tables reading each day's MITMA files only once.
+Each table can be selected independently with the --tables argument. The
+days already stored are tracked in the mitma_manifest table.
+"""
+
+# Imports
+import os
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+from datetime import datetime
+from database_utils import *
+from maestra_utils import *
+from compute_trips import compute_trips
+from compute_trips_matrix import compute_trips_matrix
+from compute_qrp_indexes import compute_trips_from_home, compute_qrp, compute_flux
+
+# Paths
+dir_maestra_1 = r'data_1TB/MITMA/maestra_1_mitma_distritos/'
+dir_maestra_2 = r'data_1TB/MITMA/maestra_2_mitma_distritos/'
+filename_maestra_1 = r'_maestra_1_mitma_distrito.txt.gz'
+filename_maestra_2 = r'_maestra_2_mitma_distrito.txt.gz'
+
+# Derived tables
+tables_list = ['mitma_trips', 'mitma_trips_matrix', 'mitma_qrp', 'mitma_flux']
+
+
+def compute_day(day, tables, chunksize=None, max_memory=max_memory_default):
+    """
+    Computes the selected tables of a day. The maestra_1 file is read
+    once and the maestra_2 file only when mitma_qrp or mitma_flux are
+    selected.
+
+    Args:
+        day (str): day to compute in format %Y%m%d
+        tables (list of str): tables to compute from tables_list
+        chunksize (int, optional): number of rows of each chunk to read
+            the MITMA files in streaming mode. Defaults to None, which
+            reads the whole files.
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes in streaming mode. Defaults to max_memory_default.
+
+    Returns:
+        dict: dataframe of each computed table
+    """
+    print('Loading data...')
+    df_matrix = read_maestra_1(os.path.join(dir_maestra_1, day + filename_maestra_1), chunksize, max_memory)
+
+    dfs = {}
+    if 'mitma_trips' in tables:
+        print('Computing trips...')
+        dfs['mitma_trips'] = compute_trips(df_matrix)
+
+    if 'mitma_trips_matrix' in tables:
+        print('Computing trips matrix...')
+        dfs['mitma_trips_matrix'] = compute_trips_matrix(df_matrix)
+
+    if ('mitma_qrp' in tables) or ('mitma_flux' in tables):
+        df_matrix_pop = read_maestra_2(os.path.join(dir_maestra_2, day + filename_maestra_2), chunksize, max_memory)
+        df_matrix_from_home = compute_trips_from_home(df_matrix)
+
+        if 'mitma_qrp' in tables:
+            print('Computing qrp parameters...')
+            dfs['mitma_qrp'] = compute_qrp(df_matrix_pop, df_matrix_from_home)
+
+        if 'mitma_flux' in tables:
+            print('Computing flux...')
+            dfs['mitma_flux'] = compute_flux(df_matrix_pop, df_matrix_from_home)
+
+    # Set day
+    for df in dfs.values():
+        df['datetime'] = datetime.strptime(day, '%Y%m%d')
+
+    return dfs
+
+
+def table_files(day, table):
+    """
+    Gets the MITMA files a table is computed from.
+
+    Args:
+        day (str): day in format %Y%m%d
+        table (str): table from tables_list
+
+    Returns:
+        list of str: paths of the files
+    """
+    paths = [os.path.join(dir_maestra_1, day + filename_maestra_1)]
+    if table in ['mitma_qrp', 'mitma_flux']:
+        paths.append(os.path.join(dir_maestra_2, day + filename_maestra_2))
+
+    return paths
+
+
+def file_stats(paths):
+    """
+    Gets the total size and the last modification time of some files.
+
+    Args:
+        paths (list of str): paths of the files
+
+    Returns:
+        (int, float): size in bytes and modification time
+    """
+    stats = [os.stat(path) for path in paths]
+
+    return sum(stat.st_size for stat in stats), max(stat.st_mtime for stat in stats)
+
+
+def file_checksum(path):
+    """
+    Computes the SHA-256 checksum of the contents of a file.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        str: hexadecimal checksum
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def files_checksum(paths, checksums):
+    """
+    Computes the checksum of the files of a table, combining the
+    checksums of each file. Files are hashed only once: their checksums
+    are kept in checksums, so the maestra_1 file of a day is read once
+    for all the tables.
+
+    Args:
+        paths (list of str): paths of the files
+        checksums (dict): checksum of each file already hashed, updated
+            with the new ones
+
+    Returns:
+        str: hexadecimal checksum
+    """
+    for path in paths:
+        if path not in checksums:
+            checksums[path] = file_checksum(path)
+
+    return hashlib.sha256(','.join(checksums[path] for path in paths).encode()).hexdigest()
+
+
+def manifest_row(day, table, status, checksum=None):
+    """
+    Builds the manifest row of the files of a day and table. Failed
+    rows don't read the files, which may be missing or unreadable, and
+    get NULL size, modification time and checksum.
+
+    Args:
+        day (str): day in format %Y%m%d
+        table (str): table from tables_list
+        status (str): 'done' or 'failed'
+        checksum (str, optional): checksum of the files. Defaults to
+            None.
+
+    Returns:
+        dict: with the mitma_manifest columns
+    """
+    paths = table_files(day, table)
+    size, mtime = file_stats(paths) if status == 'done' else (None, None)
+
+    return {
+        'day': datetime.strptime(day, '%Y%m%d'), 'table_name': table,
+        'files': ','.join(os.path.basename(path) for path in paths),
+        'size': size, 'mtime': mtime, 'checksum': checksum, 'status': status}
+
+
+def ingest_day(day, tables, chunksize=None, max_memory=max_memory_default):
+    """
+    Computes the selected tables of a day and their manifest rows.
+
+    Args:
+        day (str): day to compute in format %Y%m%d
+        tables (list of str): tables to compute from tables_list
+        chunksize (int, optional): number of rows of each chunk to read
+            the MITMA files in streaming mode. Defaults to None.
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes in streaming mode. Defaults to max_memory_default.
+
+    Returns:
+        (dict, list of dict): dataframe of each computed table and
+            manifest rows
+    """
+    checksums = {}
+    manifest_rows = [
+        manifest_row(day, table, 'done', files_checksum(table_files(day, table), checksums))
+        for table in tables]
+
+    dfs = compute_day(day, tables, chunksize, max_memory)
+
+    return dfs, manifest_rows
+
+
+def save_day(day, dfs, manifest_rows):
+    """
+    Stores the tables of a day replacing its previous rows, and records
+    it in the manifest. The regions are stored as their ids, adding the
+    new regions of the day to the regions dictionary, and the month
+    partitions of the partitioned tables are created first.
+
+    Args:
+        day (str): computed day in format %Y%m%d
+        dfs (dict): dataframe of each computed table
+        manifest_rows (list of dict): manifest rows of the day
+    """
+    encode_region_columns(dfs)
+
+    for table in dfs:
+        attach_month_partition(table, datetime.strptime(day, '%Y%m%d'))
+
+    replace_day_tables(datetime.strptime(day, '%Y%m%d'), dfs, manifest_rows)
+
+
+def store_day(day, tables, compute, *args):
+    """
+    Gets the result of a day and stores it. If computing or storing the
+    day fails, its tables are recorded as failed in the manifest.
+
+    Args:
+        day (str): day in format %Y%m%d
+        tables (list of str): tables of the day
+        compute (function): returns the result of ingest_day
+        *args: arguments of compute
+
+    Returns:
+        bool: True if the day was stored
+    """
+    try:
+        dfs, manifest_rows = compute(*args)
+        print('Saving ' + day + '...')
+        save_day(day, dfs, manifest_rows)
+        print('Done ' + day + '...')
+        return True
+    except Exception as error:
+        print('Failed ' + day + ': ' + str(error))
+
+    # A day that can't be recorded doesn't stop the other days
+    try:
+        update_manifest([manifest_row(day, table, 'failed') for table in tables])
+    except Exception as error:
+        print('Failed to record ' + day + ' as failed: ' + str(error))
+
+    return False
+
+
+def pending_days(first_date=None, last_date=None, tables=tables_list):
+    """
+    Finds the tables of each day that must be computed using the
+    manifest: days never stored or failed, and days whose files changed.
+    Files touched without changes only update their manifest rows. Days
+    without MITMA files between the first and the last one are reported.
+
+    Args:
+        first_date (str, optional): first day with format %Y%m%d.
+            Defaults to None.
+        last_date (str, optional): day to stop, not included, with format
+            %Y%m%d. Defaults to None.
+        tables (list of str, optional): tables to compute. Defaults to
+            tables_list.
+
+    Returns:
+        list of (str, list of str): days and their pending tables
+    """
+    df_manifest = query_dataframe(
+        "SELECT * FROM mitma_manifest WHERE table_name = ANY(%(tables)s)", {'tables': list(tables)})
+    manifest = {
+        (row['day'].strftime('%Y%m%d'), row['table_name']): row
+        for row in df_manifest.to_dict('records')}
+
+    file_days = sorted(
+        filename.split('_')[0] for filename in os.listdir(dir_maestra_1)
+        if filename.endswith(filename_maestra_1))
+    file_days = [
+        day for day in file_days if ((first_date is None) or (day >= first_date)) and
+        ((last_date is None) or (day < last_date))]
+
+    # Days without files
+    if file_days:
+        all_days = pd.date_range(file_days[0], file_days[-1]).strftime('%Y%m%d')
+        missing = sorted(set(all_days) - set(file_days))
+        if missing:
+            print('Days without MITMA files: ' + ', '.join(missing))
+
+    days, touched = [], []
+    for day in file_days:
+        pending_tables = []
+        checksums = {}
+        for table in tables:
+            paths = table_files(day, table)
+            if not all(os.path.exists(path) for path in paths):
+                print('Missing files of ' + table + ' for ' + day)
+                continue
+
+            row = manifest.get((day, table))
+            if (row is not None) and (row['status'] == 'done'):
+                size, mtime = file_stats(paths)
+                if (row['size'] == size) and (row['mtime'] == mtime):
+                    continue
+                checksum = files_checksum(paths, checksums)
+                if row['checksum'] == checksum:
+                    touched.append(manifest_row(day, table, 'done', checksum))
+                    continue
+
+            pending_tables.append(table)
+
+        if pending_tables:
+            days.append((day, pending_tables))
+
+    if touched:
+        update_manifest(touched)
+
+    return days
+
+
+def compute_tables(first_date=None, last_date=None, tables=tables_list, chunksize=None,
+                   max_memory=max_memory_default, workers=1, partitioned=False):
+    """
+    Computes and stores the selected tables for the days of the MITMA
+    files that the ingestion manifest doesn't have, or whose files
+    changed. Each day replaces its previous rows and is recorded in the
+    manifest in a single transaction, so an interruption never leaves
+    partial days. Failed days are recorded as failed and retried in the
+    next run.
+
+    With more than one worker, days are computed in a process pool and
+    stored as soon as they are computed. At most 2 * workers days are
+    computed or waiting to be stored at the same time, so memory stays
+    bounded when storing is slower than computing.
+
+    Tables created before the regions dictionary, with MITMA codes in
+    their region columns, are converted to region ids first (see
+    migrate_region_columns).
+
+    At the end, the period means of the periods that include the new
+    days are recomputed (see refresh_period_means).
+
+    Args:
+        first_date (str, optional): to start the computation in this
+            date with format %Y%m%d. Defaults to None.
+        last_date (str, optional): to finish the computation before
+            this date with format %Y%m%d. Defaults to None.
+        tables (list of str, optional): tables to compute. Defaults to
+            tables_list.
+        chunksize (int, optional): number of rows of each chunk to read
+            the MITMA files in streaming mode. Defaults to None, which
+            reads the whole files.
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes in streaming mode. Defaults to max_memory_default.
+        workers (int, optional): number of processes computing days in
+            parallel. Defaults to 1.
+        partitioned (bool, optional): creates the tables partitioned by
+            month if they don't exist. Defaults to False.
+    """
+    print('Create dbs')
+    if ('mitma_trips' in tables) or ('mitma_trips_matrix' in tables):
+        create_mitma_trips_tables(partitioned)
+    if ('mitma_qrp' in tables) or ('mitma_flux' in tables):
+        create_mitma_tables(partitioned)
+    create_mitma_manifest_table()
+
+    # Tables created before the regions dictionary
+    migrate_tables_to_region_ids(list(tables) + ['mitma_period_means'])
+
+    days = pending_days(first_date, last_date, tables)
+    stored_days = []
+
+    if workers == 1:
+        for day, pending_tables in days:
+            print('>- ' + day + ' -<')
+            if store_day(day, pending_tables, ingest_day, day, pending_tables, chunksize, max_memory):
+                stored_days.append(day)
+
+    else:
+        pending = iter(days)
+        futures = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # Keep the pool busy with a bounded number of days
+                for day, pending_tables in pending:
+                    futures[executor.submit(ingest_day, day, pending_tables, chunksize, max_memory)] = (
+                        day, pending_tables)
+                    if len(futures) >= 2 * workers:
+                        break
+                if not futures:
+                    break
+
+                # Store days as they are computed
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    day, pending_tables = futures.pop(future)
+                    if store_day(day, pending_tables, future.result):
+                        stored_days.append(day)
+
+    # Means of the periods that include the new days
+    if stored_days and (('mitma_trips_matrix' in tables) or ('mitma_flux' in tables)):
+        refresh_period_means(
+            datetime.strptime(min(stored_days), '%Y%m%d'), datetime.strptime(max(stored_days), '%Y%m%d'))
+
+    print('End processing')
+
+
+# Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tables', nargs='+', choices=tables_list, default=tables_list,
+        help='tables to compute. Defaults to all of them')
+    parser.add_argument('--first-date', default=None,
+        help='first day to compute (%%Y%%m%%d). Defaults to the first MITMA file')
+    parser.add_argument('--last-date', default=None,
+        help='day to stop the computation (%%Y%%m%%d), not included')
+    parser.add_argument('--chunksize', type=int, default=None,
+        help='read the MITMA files in chunks of this number of rows (streaming mode)')
+    parser.add_argument('--max-memory', type=int, default=max_memory_default // 1024**2,
+        help='memory limit in MB of the partial sums in streaming mode')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of days computed in parallel. Defaults to 1')
+    parser.add_argument('--partitioned', action='store_true',
+        help='create the tables partitioned by month, with BRIN and B-tree indexes')
+    args = parser.parse_args()
+
+    compute_tables(
+        first_date=args.first_date, last_date=args.last_date, tables=args.tables,
+        chunksize=args.chunksize, max_memory=args.max_memory * 1024**2, workers=args.workers,
+        partitioned=args.partitioned)
@@ -3,9 +3,97 @@ Functions to create, drop and query to mobility tables.
 """
 
 # Imports
+import io
+import os
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
 import psycopg2
+import psycopg2.pool
+import numpy as np
 import pandas as pd
 
+################################
+###### Database connection #####
+################################
+
+# Connection parameters. They can be set with environment variables
+db_config = {
+    'dbname': os.environ.get('MITMA_DB_NAME', 'MITMA'),
+    'user': os.environ.get('MITMA_DB_USER', 'julian'),
+    'host': os.environ.get('MITMA_DB_HOST', 'localhost'),
+    'port': int(os.environ.get('MITMA_DB_PORT', 5432)),
+    'password': os.environ.get('MITMA_DB_PASSWORD', '1234')}
+
+# Maximum number of connections kept open by the pool of each process.
+# Borrowing a connection doesn't wait: it raises PoolError when all of
+# them are in use, so it must be at least the number of threads of a
+# process querying at the same time
+db_pool_size = int(os.environ.get('MITMA_DB_POOL_SIZE', 5))
+
+# Connection pool shared by the functions of this module
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    """
+    Gets the connection pool to the PostgreSQL database. It is created
+    the first time it is used in each process.
+    Returns:
+        psycopg2 pool: connection pool
+    """
+    global _pool, _pool_pid
+
+    # Connections can't be shared with forked processes
+    if (_pool is None) or (_pool_pid != os.getpid()):
+        _pool = psycopg2.pool.ThreadedConnectionPool(1, db_pool_size, **db_config)
+        _pool_pid = os.getpid()
+
+    return _pool
+
+
+@contextmanager
+def get_connection():
+    """
+    Context manager that borrows a connection from the pool. Changes are
+    committed when the block ends, or rolled back if it raises an error.
+    Connections that are closed or can't be rolled back are discarded
+    instead of returned to the pool. It raises PoolError if the
+    db_pool_size connections of the process are in use.
+    Yields:
+        psycopg2 connection: connection to the PostgreSQL database
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def execute_queries(queries):
+    """
+    Executes sql queries in a single transaction.
+    Args:
+        queries (tuple of string): sql queries
+    """
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                for query in queries:
+                    cur.execute(query)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
 #########################
 ###### Drop tables ######
 #########################
@@ -14,24 +102,7 @@ def drop_table(table_name):
     """
     Drop tables in the PostgreSQL database
     """
-    conn = None
-    try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cur = conn.cursor()
-        # create table one by one
-        cur.execute("DROP TABLE " + table_name)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+    execute_queries(("DROP TABLE " + table_name,))
             
 ###########################
 ###### Create tables ######
@@ -39,176 +110,656 @@ def drop_table(table_name):
 
 def create_mitma_cat_raw_tables():
     """
-    Creates a table with the MITMA raw data in the PostgreSQL database
+    Creates a table with the MITMA raw data in the PostgreSQL database.
+    Regions are stored as their ids of the regions dictionary.
     """
-    conn = None
     queries = (
         """
         CREATE TABLE mitma_cat_raw (
             parameter_id SERIAL PRIMARY KEY,
             datetime timestamp default NULL,
-            source VARCHAR(255) NOT NULL,
-            target VARCHAR(255) NOT NULL,
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            target INT NOT NULL REFERENCES mitma_regions (id),
             motiv_source VARCHAR(255) NOT NULL,
             motiv_target VARCHAR(255) NOT NULL,
             residency VARCHAR(255) NOT NULL,
             hour INT NOT NULL,
             distance VARCHAR(255) NOT NULL,
             trips FLOAT NOT NULL,
-            trips_km FLOAT NOT NULL,
-        """)
-    try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cur = conn.cursor()
-        # create table
-        for query in queries:
-            cur.execute(query)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+            trips_km FLOAT NOT NULL
+        )
+        """,)
+    create_mitma_regions_table()
+    execute_queries(queries)
 
 
-def create_mitma_trips_tables():
+# Columns of the mobility tables. Regions are stored as their ids of the
+# regions dictionary
+mitma_trips_columns = """
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            trips_outcoming FLOAT NOT NULL,
+            trips_incoming FLOAT NOT NULL,
+            trips_internal FLOAT NOT NULL"""
+mitma_trips_matrix_columns = """
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            target INT NOT NULL REFERENCES mitma_regions (id),
+            trips FLOAT NOT NULL"""
+mitma_qrp_columns = """
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            q FLOAT NOT NULL,
+            r FLOAT NOT NULL,
+            p FLOAT NOT NULL"""
+mitma_flux_columns = """
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            target INT NOT NULL REFERENCES mitma_regions (id),
+            p FLOAT NOT NULL"""
+
+# Region columns of each table, indexed together with datetime in the
+# partitioned mode
+mitma_region_columns = {
+    'mitma_cat_raw': ['source', 'target'],
+    'mitma_trips': ['source'],
+    'mitma_trips_matrix': ['source', 'target'],
+    'mitma_qrp': ['source'],
+    'mitma_flux': ['source', 'target'],
+    'mitma_period_means': ['source', 'target']}
+
+
+def mobility_table_queries(table_name, columns, index_columns, partitioned=False):
+    """
+    Builds the queries to create a mobility table if it doesn't exist,
+    with a B-tree index on datetime so each day can be replaced without
+    scanning the table. In partitioned mode the table is partitioned by
+    month ranges of datetime, with a BRIN index on datetime and a B-tree
+    index on the region columns and datetime. Partitions are created
+    with attach_month_partition. The indexes are also added to existing
+    tables.
+    Args:
+        table_name (string): name of the table
+        columns (string): definition of the columns after datetime
+        index_columns (list of str): region columns of the B-tree index
+        partitioned (bool, optional): creates a partitioned table.
+                                      Defaults to False.
+    Returns:
+        tuple of string: sql queries
+    """
+    if not partitioned:
+        return (
+            "CREATE TABLE IF NOT EXISTS " + table_name + """ (
+            parameter_id SERIAL PRIMARY KEY,
+            datetime timestamp default NULL,""" + columns + """
+        )""",
+            "CREATE INDEX IF NOT EXISTS " + table_name + "_datetime ON " + table_name + " (datetime)")
+
+    # The primary key of a partitioned table must include datetime
+    return (
+        "CREATE TABLE IF NOT EXISTS " + table_name + """ (
+            parameter_id SERIAL,
+            datetime timestamp NOT NULL,""" + columns + """,
+            PRIMARY KEY (parameter_id, datetime)
+        ) PARTITION BY RANGE (datetime)""",
+        "CREATE INDEX IF NOT EXISTS " + table_name + "_datetime_brin ON " + table_name +
+        " USING BRIN (datetime)",
+        "CREATE INDEX IF NOT EXISTS " + table_name + "_" + "_".join(index_columns) + "_datetime ON " +
+        table_name + " (" + ", ".join(index_columns) + ", datetime)")
+
+
+def create_mitma_trips_tables(partitioned=False):
     """
     Creates a table with the incoming, outgoing and internal 
     trips for each MITMA region and another with the fluxes
     of each pair of MITMA regions. 
+    Args:
+        partitioned (bool, optional): creates tables partitioned by
+                                      month. Defaults to False.
+    """
+    queries = (
+        mobility_table_queries(
+            'mitma_trips', mitma_trips_columns, mitma_region_columns['mitma_trips'], partitioned) +
+        mobility_table_queries(
+            'mitma_trips_matrix', mitma_trips_matrix_columns, mitma_region_columns['mitma_trips_matrix'],
+            partitioned))
+    create_mitma_regions_table()
+    execute_queries(queries)
+
+
+def create_mitma_tables(partitioned=False):
+    """
+    Creates a table with the q, r and p mobility indexes for each MITMA
+    region and another with the fluxes of p index of each pair of MITMA
+    regions. 
+    Args:
+        partitioned (bool, optional): creates tables partitioned by
+                                      month. Defaults to False.
+    """
+    queries = (
+        mobility_table_queries(
+            'mitma_qrp', mitma_qrp_columns, mitma_region_columns['mitma_qrp'], partitioned) +
+        mobility_table_queries(
+            'mitma_flux', mitma_flux_columns, mitma_region_columns['mitma_flux'], partitioned))
+    create_mitma_regions_table()
+    execute_queries(queries)
+
+
+def attach_month_partition(table_name, date):
+    """
+    Creates the partition of the month of date in a table partitioned by
+    month, if it doesn't exist yet. Tables that are not partitioned are
+    left untouched, so it can be called before every insert.
+    Args:
+        table_name (string): mitma_trips, mitma_trips_matrix, mitma_qrp
+                             or mitma_flux
+        date (datetime): day to insert
+    """
+    first_day = datetime(date.year, date.month, 1)
+    next_first_day = datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    partition_name = table_name + "_" + first_day.strftime('%Y%m')
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table_name,))
+                if cursor.fetchone() is not None:
+                    cursor.execute(
+                        "CREATE TABLE IF NOT EXISTS " + partition_name + " PARTITION OF " + table_name +
+                        " FOR VALUES FROM (%s) TO (%s)", (first_day, next_first_day))
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def create_mitma_period_tables():
+    """
+    Creates a table with the periods of study (phases and motivs) and
+    another with the mean trips and mean p index of each pair of MITMA
+    regions in each period. The tables are kept if they already exist.
     """
-    conn = None
     queries = (
         """
-        CREATE TABLE mitma_trips (
-            parameter_id SERIAL PRIMARY KEY,
-            datetime timestamp default NULL,
-            source VARCHAR(255) NOT NULL,
-            trips_outcoming FLOAT NOT NULL,
-            trips_incoming FLOAT NOT NULL,
-            trips_internal FLOAT NOT NULL
+        CREATE TABLE IF NOT EXISTS mitma_periods (
+            period VARCHAR(255) PRIMARY KEY,
+            period_type VARCHAR(255) NOT NULL,
+            start_date date NOT NULL,
+            end_date date NOT NULL
         )
         """,
-        """ CREATE TABLE mitma_trips_matrix (
-                parameter_id SERIAL PRIMARY KEY,
-                datetime timestamp default NULL,
-                source VARCHAR(255) NOT NULL,
-                destination VARCHAR(255) NOT NULL,
-                trips FLOAT NOT NULL,
-                )
+        """
+        CREATE TABLE IF NOT EXISTS mitma_period_means (
+            period VARCHAR(255) NOT NULL,
+            source INT NOT NULL REFERENCES mitma_regions (id),
+            target INT NOT NULL REFERENCES mitma_regions (id),
+            trips FLOAT,
+            trips_days INT NOT NULL,
+            p FLOAT,
+            p_days INT NOT NULL,
+            PRIMARY KEY (period, source, target)
+        )
         """)
+    create_mitma_regions_table()
+    execute_queries(queries)
+
+
+def create_mitma_manifest_table():
+    """
+    Creates a table with the MITMA files ingested into each mobility
+    table: day, files, total size, last modification time, checksum and
+    status. Failed days have no size, modification time and checksum.
+    The table is kept if it already exists.
+    """
+    queries = (
+        """
+        CREATE TABLE IF NOT EXISTS mitma_manifest (
+            day date NOT NULL,
+            table_name VARCHAR(255) NOT NULL,
+            files TEXT NOT NULL,
+            size BIGINT,
+            mtime FLOAT,
+            checksum VARCHAR(64),
+            status VARCHAR(16) NOT NULL,
+            updated_at timestamp NOT NULL default now(),
+            PRIMARY KEY (day, table_name)
+        )
+        """,)
+    execute_queries(queries)
+
+
+def create_mitma_regions_table():
+    """
+    Creates the dictionary of MITMA regions, with the int id, province
+    (first two digits) and municipality (first five digits) of each
+    MITMA code. The table is kept if it already exists.
+    """
+    queries = (
+        """
+        CREATE TABLE IF NOT EXISTS mitma_regions (
+            id INT PRIMARY KEY,
+            code VARCHAR(255) NOT NULL UNIQUE,
+            province VARCHAR(2) NOT NULL,
+            municipality VARCHAR(5) NOT NULL
+        )
+        """,)
+    execute_queries(queries)
+
+
+##########################
+###### Insert tables #####
+##########################
+
+def copy_dataframe(cursor, df, table_name, chunksize=500_000):
+    """
+    Inserts a dataframe into a table streaming it as CSV through
+    PostgreSQL COPY FROM STDIN. Columns are matched by name.
+    Args:
+        cursor (psycopg2 cursor): cursor of an open transaction
+        df (dataframe): rows to insert
+        table_name (string): table where rows are inserted
+        chunksize (int, optional): rows sent by each COPY. Defaults to
+                                   500_000
+    """
+    columns = ', '.join(df.columns)
+    query = "COPY " + table_name + " (" + columns + ") FROM STDIN WITH (FORMAT csv)"
+
+    for start in range(0, len(df), chunksize):
+        buffer = io.StringIO()
+        df.iloc[start:start + chunksize].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(query, buffer)
+
+
+# Insert or update the manifest row of a day and table
+manifest_upsert_query = """
+    INSERT INTO mitma_manifest (day, table_name, files, size, mtime, checksum, status)
+    VALUES (%(day)s, %(table_name)s, %(files)s, %(size)s, %(mtime)s, %(checksum)s, %(status)s)
+    ON CONFLICT (day, table_name) DO UPDATE SET
+        files = EXCLUDED.files, size = EXCLUDED.size, mtime = EXCLUDED.mtime,
+        checksum = EXCLUDED.checksum, status = EXCLUDED.status, updated_at = now()
+    """
+
+
+def replace_day_tables(day, dfs, manifest_rows):
+    """
+    Replaces the rows of a day in its tables and records them in the
+    manifest in a single transaction, so a day is either fully stored
+    and recorded or not stored at all.
+    Args:
+        day (datetime): stored day
+        dfs (dict): dataframe to insert into each table name
+        manifest_rows (list of dict): manifest rows of the day, with the
+                                      mitma_manifest columns
+    """
     try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cur = conn.cursor()
-        # create table one by one
-        for query in queries:
-            cur.execute(query)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                for table_name, df in dfs.items():
+                    cur.execute("DELETE FROM " + table_name + " WHERE datetime = %s", (day,))
+                    copy_dataframe(cur, df, table_name)
+                cur.executemany(manifest_upsert_query, manifest_rows)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+        raise
 
 
-def create_mitma_tables():
+def update_manifest(manifest_rows):
     """
-    Creates a table with the q, r and p mobility indexes for each MITMA
-    region and another with the fluxes of p index of each pair of MITMA
-    regions. 
+    Inserts or updates manifest rows, e.g. to record failed days or
+    files touched without changes.
+    Args:
+        manifest_rows (list of dict): rows with the mitma_manifest
+                                      columns
     """
-    conn = None
-    queries = (
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.executemany(manifest_upsert_query, manifest_rows)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def fetch_region_ids(cursor, codes):
+    """
+    Gets the ids of the MITMA codes that are in the regions dictionary.
+    Args:
+        cursor (psycopg2 cursor): cursor of an open transaction
+        codes (list of str): MITMA codes
+    Returns:
+        dict: id of each stored code
+    """
+    cursor.execute("SELECT code, id FROM mitma_regions WHERE code = ANY(%s)", (list(codes),))
+
+    return dict(cursor.fetchall())
+
+
+def add_regions(codes):
+    """
+    Adds the MITMA codes that aren't in the regions dictionary yet. New
+    codes get the next ids, in code order among them, so the ids follow
+    the order of the codes only within each load. The table is only
+    locked when there
+    are new codes, to give unique ids when several processes add them.
+    Args:
+        codes (list of str): MITMA codes
+    Returns:
+        series: id of each code, indexed by code
+    """
+    codes = sorted({str(code) for code in codes})
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                ids = fetch_region_ids(cur, codes)
+                if len(ids) < len(codes):
+                    # Other processes may have added them meanwhile
+                    cur.execute("LOCK TABLE mitma_regions IN EXCLUSIVE MODE")
+                    ids = fetch_region_ids(cur, codes)
+                    new_codes = [code for code in codes if code not in ids]
+
+                    cur.execute("SELECT coalesce(max(id) + 1, 0) FROM mitma_regions")
+                    first_id = cur.fetchone()[0]
+                    df = pd.DataFrame({
+                        'id': np.arange(first_id, first_id + len(new_codes)), 'code': new_codes})
+                    df['province'] = df['code'].str[:2]
+                    df['municipality'] = df['code'].str[:5]
+                    copy_dataframe(cur, df, 'mitma_regions')
+                    ids.update(zip(df['code'], df['id'].tolist()))
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        raise
+
+    return pd.Series(ids, dtype=np.int32).reindex(codes)
+
+
+def encode_region_columns(dfs):
+    """
+    Replaces the MITMA codes of the region columns of some dataframes
+    with their ids, adding the new codes to the regions dictionary.
+    Args:
+        dfs (dict): dataframe of each table name, modified in place
+    """
+    codes = set()
+    for table_name, df in dfs.items():
+        for column in mitma_region_columns[table_name]:
+            codes.update(pd.unique(np.asarray(df[column], dtype=object)))
+    ids = add_regions(codes)
+
+    for table_name, df in dfs.items():
+        for column in mitma_region_columns[table_name]:
+            df[column] = ids.values[ids.index.get_indexer(np.asarray(df[column], dtype=str))]
+
+
+def migrate_region_columns(table_name):
+    """
+    Converts the VARCHAR region columns of a table created before the
+    regions dictionary to ids referencing mitma_regions. Indexes are
+    rebuilt by PostgreSQL.
+    Args:
+        table_name (string): table from mitma_region_columns
+    """
+    columns = mitma_region_columns[table_name]
+    create_mitma_regions_table()
+    df_codes = query_dataframe(" UNION ".join(
+        "SELECT DISTINCT " + column + "::text AS code FROM " + table_name for column in columns))
+    add_regions(df_codes['code'])
+
+    print('Migrating regions of ' + table_name)
+    execute_queries((
         """
-        CREATE TABLE mitma_qrp (
-            parameter_id SERIAL PRIMARY KEY,
-            datetime timestamp default NULL,
-            source VARCHAR(255) NOT NULL,
-            q FLOAT NOT NULL,
-            r FLOAT NOT NULL,
-            p FLOAT NOT NULL
-        )
+        CREATE OR REPLACE FUNCTION mitma_region_id(region_code text) RETURNS INT AS
+        $$ SELECT id FROM mitma_regions WHERE code = region_code $$ LANGUAGE sql STABLE
         """,
-        """ CREATE TABLE mitma_flux (
-                parameter_id SERIAL PRIMARY KEY,
-                datetime timestamp default NULL,
-                source VARCHAR(255) NOT NULL,
-                target VARCHAR(255) NOT NULL,
-                p FLOAT NOT NULL
-                )
-        """)
+        "ALTER TABLE " + table_name + " " + ", ".join(
+            "ALTER COLUMN " + column + " TYPE INT USING mitma_region_id(" + column + ")"
+            for column in columns) + ", " + ", ".join(
+            "ADD FOREIGN KEY (" + column + ") REFERENCES mitma_regions (id)" for column in columns)))
+
+
+def has_region_codes(table_name):
+    """
+    Checks if the region columns of a table store MITMA codes instead of
+    region ids, i.e. the table was created before the regions
+    dictionary.
+    Args:
+        table_name (string): table from mitma_region_columns
+    Returns:
+        bool: True if some region column isn't an integer. False if the
+              table doesn't exist
+    """
+    df = query_dataframe(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %(table)s AND column_name = ANY(%(columns)s)
+        """, {'table': table_name, 'columns': mitma_region_columns[table_name]})
+    if df.empty:
+        return False
+
+    return bool((df['data_type'] != 'integer').any())
+
+
+def migrate_tables_to_region_ids(table_names):
+    """
+    Converts the tables created before the regions dictionary to region
+    ids, so region ids are never inserted as text next to MITMA codes.
+    Args:
+        table_names (list of str): tables from mitma_region_columns
+    """
+    for table_name in table_names:
+        if has_region_codes(table_name):
+            migrate_region_columns(table_name)
+
+
+##########################
+###### Period means ######
+##########################
+
+# Mean trips (mitma_trips_matrix) and mean p (mitma_flux) of each pair of
+# regions in the selected periods. Pairs without trips or without p in a
+# period get NULL and 0 days
+period_means_query = """
+    INSERT INTO mitma_period_means (period, source, target, trips, trips_days, p, p_days)
+    WITH periods AS (
+        SELECT * FROM mitma_periods WHERE period = ANY(%(periods)s)
+    ), trips AS (
+        SELECT periods.period, m.source, m.target, avg(m.trips) AS trips, count(*) AS days
+        FROM periods JOIN mitma_trips_matrix m
+        ON m.datetime BETWEEN periods.start_date AND periods.end_date
+        GROUP BY periods.period, m.source, m.target
+    ), flux AS (
+        SELECT periods.period, f.source, f.target, avg(f.p) AS p, count(*) AS days
+        FROM periods JOIN mitma_flux f
+        ON f.datetime BETWEEN periods.start_date AND periods.end_date
+        GROUP BY periods.period, f.source, f.target
+    )
+    SELECT coalesce(trips.period, flux.period), coalesce(trips.source, flux.source),
+        coalesce(trips.target, flux.target), trips.trips, coalesce(trips.days, 0),
+        flux.p, coalesce(flux.days, 0)
+    FROM trips FULL OUTER JOIN flux
+    ON trips.period = flux.period AND trips.source = flux.source AND trips.target = flux.target
+    """
+
+
+def refresh_period_means(first_date=None, last_date=None, periods=None):
+    """
+    Recomputes the mean trips and mean p of each pair of MITMA regions
+    for the periods that overlap the days between first_date and
+    last_date, in a single transaction. Nothing is done if the period
+    tables don't exist.
+    Args:
+        first_date (datetime, optional): first changed day. Defaults to
+                                         None, which refreshes all the
+                                         periods.
+        last_date (datetime, optional): last changed day. Defaults to
+                                        None.
+        periods (list of str, optional): periods to refresh instead of
+                                         the ones overlapping the days.
+                                         Defaults to None.
+    """
     try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cur = conn.cursor()
-        # create table one by one
-        for query in queries:
-            cur.execute(query)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass('mitma_periods') IS NOT NULL")
+                if not cursor.fetchone()[0]:
+                    return
+
+                # Periods affected by the changed days
+                if periods is None:
+                    query = "SELECT period FROM mitma_periods"
+                    if first_date is not None:
+                        query += " WHERE start_date <= %(last_date)s AND end_date >= %(first_date)s"
+                    cursor.execute(query, {'first_date': first_date, 'last_date': last_date})
+                    periods = [record[0] for record in cursor.fetchall()]
+                if not periods:
+                    return
+
+                print('Refreshing period means: ' + ', '.join(periods))
+                cursor.execute(
+                    "DELETE FROM mitma_period_means WHERE period = ANY(%(periods)s)",
+                    {'periods': periods})
+                cursor.execute(period_means_query, {'periods': periods})
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
+def store_periods(periods):
+    """
+    Stores the periods of study and computes their means. Periods whose
+    dates don't change keep their stored means, and the stored periods
+    that aren't in periods are deleted with their means.
+    Args:
+        periods (list of tuple): (period, period_type, start_date,
+                                 end_date) of each period, with dates in
+                                 format %Y-%m-%d
+    """
+    create_mitma_period_tables()
+    migrate_tables_to_region_ids(['mitma_period_means'])
+
+    changed = []
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                for period, period_type, start_date, end_date in periods:
+                    cursor.execute(
+                        """
+                        INSERT INTO mitma_periods (period, period_type, start_date, end_date)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (period) DO UPDATE SET
+                            period_type = EXCLUDED.period_type,
+                            start_date = EXCLUDED.start_date,
+                            end_date = EXCLUDED.end_date
+                        WHERE (mitma_periods.start_date, mitma_periods.end_date) IS DISTINCT FROM
+                            (EXCLUDED.start_date, EXCLUDED.end_date)
+                        RETURNING period
+                        """, (period, period_type, start_date, end_date))
+                    changed += [record[0] for record in cursor.fetchall()]
+
+                # Periods removed from the study
+                names = [period[0] for period in periods]
+                cursor.execute(
+                    "DELETE FROM mitma_period_means WHERE NOT (period = ANY(%(periods)s))",
+                    {'periods': names})
+                cursor.execute(
+                    "DELETE FROM mitma_periods WHERE NOT (period = ANY(%(periods)s))",
+                    {'periods': names})
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        raise
+
+    refresh_period_means(periods=changed)
+
 
 ##########################
 ###### Query tables ######
 ##########################
 
-def query_parameters_cat(query, mitma_layers):
+# Dataframe types of the PostgreSQL column types (by type OID). Integers
+# and booleans use the pandas nullable types, as columns can have NULLs.
+# Other types are kept as python objects
+pg_dtypes = {
+    16: 'boolean', 20: 'Int64', 21: 'Int16', 23: 'Int32', 700: 'float32',
+    701: 'float64', 1700: 'float64', 1082: 'datetime64[ns]',
+    1114: 'datetime64[ns]'}
+
+
+def description_dtypes(description):
+    """
+    Gets the dataframe types of the columns of a query result.
+    Args:
+        description (tuple): cursor.description of the query
+    Returns:
+        dict: dataframe type of each column, object if the PostgreSQL
+              type isn't in pg_dtypes
+    """
+    return {x.name: pg_dtypes.get(x.type_code, 'object') for x in description}
+
+
+def date_conditions(date1=None, date2=None):
+    """
+    Builds the sql conditions of a date range on the datetime column,
+    with the date1 and date2 query variables. Missing bounds are open.
+    Args:
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults
+                               to None.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults to
+                               None.
+    Returns:
+        list of str: conditions of the set bounds
+    """
+    conditions = []
+    if date1 is not None:
+        conditions.append("datetime >= %(date1)s")
+    if date2 is not None:
+        conditions.append("datetime <= %(date2)s")
+
+    return conditions
+
+
+def query_dataframe(query, parameters=None):
+    """
+    Performs an sql query and returns its result as a dataframe.
+    Args:
+        query (string): sql query
+        parameters (dict, optional): values of the query variables.
+                                     Defaults to None.
+    Returns:
+        dataframe: result of query
+    """
+    df = pd.DataFrame()
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, parameters)
+                df = pd.DataFrame(cursor.fetchall(), columns=[x.name for x in cursor.description])
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+    return df
+
+
+def query_parameters_cat(query, mitma_layers, itersize=None):
     """
     Performs a query using the mitma layers list to filter MITMA
         regions.
     Args:
-        query (string): sql query with a 'parameter_array' variable to 
-                        filter the query
+        query (string): sql query with a 'parameter_array' variable of
+                        region ids to filter the query
         mitma_layers (list of str): MITMA zones to filter the query
+        itersize (int, optional): if set, the result is streamed from a
+                                  server-side cursor in chunks of this
+                                  number of rows. Defaults to None.
     Returns:
         dataframe: result of query
     """
+    ids = []
     try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cursor = conn.cursor()
-        # create table one by one
-        cursor.execute(query, {"parameter_array": list(mitma_layers)})
-        # close communication with the PostgreSQL database server
-        # records = cursor.fetchall()
-        df = pd.DataFrame(cursor.fetchall())
-        df.columns = [x.name for x in cursor.description]
-
-        cursor.close()
-        # commit the changes
-        conn.commit()
-
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                ids = list(fetch_region_ids(cur, mitma_layers).values())
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+    parameters = {"parameter_array": ids}
 
-    return df
+    if itersize is not None:
+        return query_dataframe_preallocated(query, parameters, itersize)
+
+    return query_dataframe(query, parameters)
 
 
 def query_no_parameters(query):
@@ -219,29 +770,123 @@ def query_no_parameters(query):
     Returns:
         dataframe: result of query
     """
+    return query_dataframe(query)
+
+
+def fetch_dataframe_chunks(conn, query, parameters=None, itersize=100_000):
+    """
+    Performs an sql query with a server-side cursor and yields its
+    result as typed dataframes of at most itersize rows.
+    Args:
+        conn (psycopg2 connection): connection to the PostgreSQL database
+        query (string): sql query
+        parameters (dict, optional): values of the query variables.
+                                     Defaults to None.
+        itersize (int, optional): rows fetched from the server in each
+                                  chunk. Defaults to 100_000.
+    Yields:
+        dataframe: chunk of the query result
+    """
+    with conn.cursor(name='mitma_' + uuid.uuid4().hex) as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query, parameters)
+
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            dtypes = description_dtypes(cursor.description)
+            yield pd.DataFrame.from_records(rows, columns=list(dtypes)).astype(dtypes)
 
+
+def query_dataframe_chunks(query, parameters=None, itersize=100_000):
+    """
+    Performs an sql query and yields its result as typed dataframes of
+    at most itersize rows. Rows are streamed from a server-side cursor,
+    so the whole result is never held in memory.
+    Args:
+        query (string): sql query
+        parameters (dict, optional): values of the query variables.
+                                     Defaults to None.
+        itersize (int, optional): rows fetched from the server in each
+                                  chunk. Defaults to 100_000.
+    Yields:
+        dataframe: chunk of the query result
+    """
     try:
-        # read the connection parameters
-        config = {'dbname': 'MITMA', 'user': 'julian', 'host': 'localhost', 'password': '1234'}
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**config)
-        cursor = conn.cursor()
-        # create table one by one
-        cursor.execute(query)
-        # close communication with the PostgreSQL database server
-        # records = cursor.fetchall()
-        df = pd.DataFrame(cursor.fetchall())
-        df.columns = [x.name for x in cursor.description]
-
-        cursor.close()
-        # commit the changes
-        conn.commit()
+        with get_connection() as conn:
+            yield from fetch_dataframe_chunks(conn, query, parameters, itersize)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        raise
+
+
+def query_dataframe_preallocated(query, parameters=None, itersize=100_000):
+    """
+    Performs an sql query streaming its result from a server-side
+    cursor. The chunks are copied straight into preallocated columns,
+    typed from the cursor description, which double their size when
+    they are full. Columns with nullable types keep a mask of NULLs.
+    Args:
+        query (string): sql query
+        parameters (dict, optional): values of the query variables.
+                                     Defaults to None.
+        itersize (int, optional): rows fetched from the server in each
+                                  chunk. Defaults to 100_000.
+    Returns:
+        dataframe: result of query
+    """
+    df = pd.DataFrame()
+    try:
+        with get_connection() as conn:
+            with conn.cursor(name='mitma_' + uuid.uuid4().hex) as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, parameters)
+
+                dtypes, values, masks = None, {}, {}
+                n_rows = 0
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if dtypes is None:
+                        # Allocate the columns with the result types
+                        dtypes = description_dtypes(cursor.description)
+                        for name, dtype in dtypes.items():
+                            dtype = pd.api.types.pandas_dtype(dtype)
+                            nullable = isinstance(dtype, pd.api.extensions.ExtensionDtype)
+                            values[name] = np.empty(
+                                itersize, dtype=dtype.numpy_dtype if nullable else dtype)
+                            if nullable:
+                                masks[name] = np.empty(itersize, dtype=bool)
+                    if not rows:
+                        break
 
+                    # Grow the columns geometrically
+                    end = n_rows + len(rows)
+                    if end > len(next(iter(values.values()))):
+                        size = max(end, 2 * len(next(iter(values.values()))))
+                        for columns in (values, masks):
+                            for name in columns:
+                                columns[name] = np.resize(columns[name], size)
+
+                    chunk = pd.DataFrame.from_records(rows, columns=list(dtypes)).astype(dtypes)
+                    for name in dtypes:
+                        if name in masks:
+                            masks[name][n_rows:end] = chunk[name].isna().values
+                            values[name][n_rows:end] = chunk[name].to_numpy(
+                                dtype=values[name].dtype, na_value=0)
+                        else:
+                            values[name][n_rows:end] = chunk[name].to_numpy()
+                    n_rows = end
+
+            columns = {}
+            for name, dtype in dtypes.items():
+                if name in masks:
+                    columns[name] = pd.array(values[name][:n_rows], dtype=dtype)
+                    columns[name][masks[name][:n_rows]] = pd.NA
+                else:
+                    columns[name] = pd.Series(values[name][:n_rows], dtype=dtype, copy=False)
+            df = pd.DataFrame(columns, copy=False)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
     return df
-
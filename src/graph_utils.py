@@ -0,0 +1,555 @@
+"""
+Functions to prepare the mobility graphs of the notebooks from the
+mitma_trips_matrix and mitma_flux dataframes.
+"""
+
+# Imports
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def compute_total_and_inverse(df, weight='p'):
+    """
+    Adds the weight of the reverse edge (same regions, opposite
+    direction), the total weight of both directions and the inverse
+    weight of each edge. The reverse edges are found with a single
+    self-join on (source, target) and (target, source).
+
+    Each pair of opposite edges is kept once: the edge that comes later
+    in the dataframe is flagged in the 'to_remove' column. Edges without
+    a reverse edge, or with duplicated ones, get a reverse weight of 0.
+
+    Args:
+        df (dataframe): with source, target and weight columns
+        weight (str, optional): weight column, 'p' for the mitma_flux
+            graphs and 'trips' for the mitma_trips_matrix ones. Defaults
+            to 'p'.
+
+    Returns:
+        dataframe: df with 'reverse_<weight>', 'to_remove',
+            'total_<weight>' and 'inverse_<weight>' columns
+    """
+    edges = pd.DataFrame({
+        'source': df['source'].values, 'target': df['target'].values,
+        'weight': df[weight].values, 'position': np.arange(len(df))})
+
+    # First occurrence and number of occurrences of each edge
+    grouped = edges.groupby(['source', 'target'], sort=False)
+    edges['count'] = grouped['position'].transform('size')
+    reverse = grouped.agg(
+        reverse_weight=('weight', 'first'), reverse_position=('position', 'first'),
+        reverse_count=('position', 'size'))
+
+    # Reverse edge of each edge, keeping the order of df
+    edges = edges.merge(reverse, how='left', left_on=['target', 'source'], right_index=True)
+    has_reverse = (edges['reverse_count'] == 1).values
+
+    df = df.assign(**{
+        'reverse_' + weight: np.where(has_reverse, edges['reverse_weight'].values, 0),
+        'to_remove': (edges['count'] == 1).values & (edges['reverse_position'] < edges['position']).values})
+    df['total_' + weight] = df[weight] + df['reverse_' + weight]
+    df['inverse_' + weight] = 1 / df[weight]
+
+    return df
+
+
+def build_sparse_graph(
+    df, weights, nodes=None, df_nodes=None, node_attributes=('geometry', 'centroid'),
+    df_distances=None, distance_attributes=('geo_distance', 'geo_distance_b')):
+    """
+    Builds a directed graph as a CSR adjacency (indptr and indices) with
+    one array of each edge attribute in the order of the CSR indices. 
+    Node and edge attributes are joined with vectorized lookups.
+
+    Nodes are the region ids of the regions dictionary, e.g. from
+    query_table(..., decode=False); their MITMA codes are only needed
+    for display (see graph_to_networkx).
+
+    Like networkx, repeated edges keep the attributes of the last row
+    and edges from a node to itself (e.g. internal trips) are kept as
+    self-loops.
+    Edges without distance get NaN, or code -1 for the categorical 
+    distance bins, whose labels are stored in 'categories'.
+
+    Args:
+        df (dataframe): edges with source, target and weights columns
+        weights (list of str): edge attribute columns of df, e.g. 
+            ['p', 'inverse_p', 'total_p']
+        nodes (array of int, optional): region ids of the nodes of the
+            graph, in the order of their node ids. Defaults to None, 
+            which uses the sorted sources and targets of df.
+        df_nodes (dataframe, optional): with a source column with the
+            nodes and the node attributes. Defaults to None.
+        node_attributes (tuple of str, optional): node attribute columns
+            of df_nodes. Defaults to ('geometry', 'centroid').
+        df_distances (dataframe, optional): with source, target and the
+            distance attributes of each pair of nodes. Defaults to None.
+        distance_attributes (tuple of str, optional): edge attribute 
+            columns of df_distances. Defaults to ('geo_distance', 
+            'geo_distance_b').
+
+    Returns:
+        dict: with 'nodes', 'indptr', 'indices', 'sources' (node id of 
+            the source of each edge), 'edges' (dict of edge attribute 
+            arrays), 'node_attributes' (dict of node attribute arrays) 
+            and 'categories' (labels of the categorical attributes)
+    """
+    if nodes is None:
+        nodes = np.union1d(df['source'].unique(), df['target'].unique())
+    nodes = pd.Index(nodes)
+    n_nodes = len(nodes)
+
+    # Edges sorted by source and target ids, keeping the last repeated one
+    sources = nodes.get_indexer(df['source'])
+    targets = nodes.get_indexer(df['target'])
+    if (sources == -1).any() or (targets == -1).any():
+        raise KeyError('Edges with nodes that are not in the graph nodes')
+    keys = sources.astype(np.int64) * n_nodes + targets
+    order = np.argsort(keys, kind='stable')
+    last = np.append(keys[order][1:] != keys[order][:-1], True)
+    order, keys = order[last], keys[order][last]
+
+    graph = {
+        'nodes': nodes, 
+        'indptr': np.concatenate([[0], np.cumsum(np.bincount(sources[order], minlength=n_nodes))]),
+        'indices': targets[order],
+        'sources': sources[order],
+        'edges': {weight: df[weight].values[order] for weight in weights},
+        'node_attributes': {},
+        'categories': {}}
+
+    # Node attributes in the order of the node ids
+    if df_nodes is not None:
+        df_nodes = df_nodes.drop_duplicates('source', keep='last').set_index('source').reindex(nodes)
+        for attribute in node_attributes:
+            graph['node_attributes'][attribute] = df_nodes[attribute].values
+
+    # Distance of each edge
+    if df_distances is not None:
+        distance_sources = nodes.get_indexer(df_distances['source'])
+        distance_targets = nodes.get_indexer(df_distances['target'])
+        distance_keys = distance_sources.astype(np.int64) * n_nodes + distance_targets
+        distance_keys[(distance_sources == -1) | (distance_targets == -1)] = -1
+
+        # Position of each edge in df_distances, the last one if repeated
+        positions = pd.Series(np.arange(len(distance_keys)), index=distance_keys)
+        positions = positions[~positions.index.duplicated(keep='last')]
+        positions = positions.reindex(keys, fill_value=-1).values
+        found = positions != -1
+
+        for attribute in distance_attributes:
+            values = df_distances[attribute]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                graph['categories'][attribute] = list(values.cat.categories)
+                codes = values.cat.codes.values.astype(np.int8)
+                graph['edges'][attribute] = np.where(found, codes[positions], -1).astype(np.int8)
+            else:
+                graph['edges'][attribute] = np.where(found, values.values.astype(np.float64)[positions], np.nan)
+
+    return graph
+
+
+def graph_matrix(graph, weight):
+    """
+    Gets the CSR sparse matrix of an edge attribute of a graph from
+    build_sparse_graph. It shares the arrays of the graph.
+
+    Args:
+        graph (dict): graph from build_sparse_graph
+        weight (str): edge attribute
+
+    Returns:
+        csr_matrix: (nodes x nodes) matrix with the edge attribute
+    """
+    n_nodes = len(graph['nodes'])
+
+    return sparse.csr_matrix(
+        (graph['edges'][weight], graph['indices'], graph['indptr']), shape=(n_nodes, n_nodes), copy=False)
+
+
+def graph_to_networkx(graph, edge_attributes=None, node_attributes=True, labels=None):
+    """
+    Exports a graph from build_sparse_graph to a networkx DiGraph, e.g.
+    to plot it. Nodes and edges are added in bulk with their attributes.
+
+    Args:
+        graph (dict): graph from build_sparse_graph
+        edge_attributes (list of str, optional): edge attributes to 
+            export. Defaults to None, which exports all of them.
+        node_attributes (bool, optional): exports the node attributes. 
+            Defaults to True.
+        labels (list of str, optional): 'label' attribute of each node,
+            e.g. decode_regions(graph['nodes']) for the MITMA codes.
+            Defaults to None.
+
+    Returns:
+        DiGraph: networkx graph with the nodes of the graph as keys
+    """
+    if edge_attributes is None:
+        edge_attributes = list(graph['edges'])
+
+    nodes = graph['nodes']
+    G = nx.DiGraph()
+
+    # Nodes and their attributes
+    columns = {}
+    if node_attributes:
+        columns = {attribute: list(values) for attribute, values in graph['node_attributes'].items()}
+    if labels is not None:
+        columns['label'] = list(labels)
+    G.add_nodes_from(
+        (node, {attribute: values[i] for attribute, values in columns.items()})
+        for i, node in enumerate(nodes.tolist()))
+
+    # Edges and their attributes. Categorical attributes get their labels
+    columns = {}
+    for attribute in edge_attributes:
+        values = graph['edges'][attribute]
+        if attribute in graph['categories']:
+            labels = np.asarray(graph['categories'][attribute] + [np.nan], dtype=object)
+            values = labels[values]
+        columns[attribute] = values.tolist()
+    G.add_edges_from(
+        (source, target, {attribute: values[i] for attribute, values in columns.items()})
+        for i, (source, target) in enumerate(zip(
+            nodes[graph['sources']].tolist(), nodes[graph['indices']].tolist())))
+
+    return G
+
+
+def compute_shortest_paths(graph, weight=None):
+    """
+    Computes the shortest paths between all the pairs of nodes of a 
+    graph from build_sparse_graph with Dijkstra. Paths are not built;
+    they are reconstructed on demand from the predecessor matrix with
+    shortest_path. Edges without weight (NaN) are ignored, unless
+    weight is None, which counts every edge of the graph.
+
+    Args:
+        graph (dict): graph from build_sparse_graph
+        weight (str, optional): edge attribute used as length, e.g. 
+            'inverse_p' or 'geo_distance'. Defaults to None, which 
+            counts the edges.
+
+    Returns:
+        (array, array): (nodes x nodes) distance matrix (inf if there is
+            no path) and predecessor matrix with the node id before the
+            target in each shortest path (-1 if there is no path)
+    """
+    n_nodes = len(graph['nodes'])
+    if weight is None:
+        # Every edge counts once, whatever its attributes
+        matrix = sparse.csr_matrix(
+            (np.ones(len(graph['indices'])), graph['indices'], graph['indptr']), shape=(n_nodes, n_nodes))
+    else:
+        matrix = graph_matrix(graph, weight)
+
+        # Remove edges without weight
+        valid = ~np.isnan(matrix.data)
+        if not valid.all():
+            matrix = sparse.csr_matrix(
+                (matrix.data[valid], (graph['sources'][valid], graph['indices'][valid])), shape=matrix.shape)
+
+    distances, predecessors = csgraph.dijkstra(
+        matrix, directed=True, return_predecessors=True, unweighted=weight is None)
+
+    # Smallest integer type for the node ids
+    dtype = np.int16 if n_nodes < np.iinfo(np.int16).max else np.int32
+    predecessors = np.where(predecessors < 0, -1, predecessors).astype(dtype)
+
+    return distances, predecessors
+
+
+def compute_path_lengths(predecessors):
+    """
+    Computes the number of nodes of each shortest path, source and 
+    target included, from a predecessor matrix.
+
+    Args:
+        predecessors (array): predecessor matrix from 
+            compute_shortest_paths
+
+    Returns:
+        array: (nodes x nodes) number of nodes of each path, 0 if there
+            is no path and 1 from a node to itself
+    """
+    n_nodes = len(predecessors)
+    rows = np.arange(n_nodes)[:, None]
+
+    # Walk all the paths back at the same time, one edge per step
+    lengths = np.zeros(predecessors.shape, dtype=np.int32)
+    current = predecessors.astype(np.intp)
+    while (current >= 0).any():
+        lengths += current >= 0
+        current = np.where(current >= 0, predecessors[rows, np.maximum(current, 0)], -1)
+
+    # Number of edges to number of nodes
+    lengths[lengths > 0] += 1
+    lengths[np.diag_indices(n_nodes)] = 1
+
+    return lengths
+
+
+def shortest_path(graph, predecessors, source, target):
+    """
+    Reconstructs the shortest path between two nodes.
+
+    Args:
+        graph (dict): graph from build_sparse_graph
+        predecessors (array): predecessor matrix from 
+            compute_shortest_paths
+        source: source node
+        target: target node
+
+    Returns:
+        list: nodes of the path from source to target. Empty if there
+            is no path
+    """
+    nodes = graph['nodes']
+    i, j = nodes.get_loc(source), nodes.get_loc(target)
+
+    path = [j]
+    while path[-1] != i:
+        previous = predecessors[i, path[-1]]
+        if previous < 0:
+            return []
+        path.append(previous)
+
+    return nodes[path[::-1]].tolist()
+
+
+def average_shortest_path_length(distances):
+    """
+    Computes the average shortest path length from a distance matrix,
+    as networkx does for strongly connected graphs. Pairs without path
+    are not counted.
+
+    Args:
+        distances (array): distance matrix from compute_shortest_paths
+
+    Returns:
+        float: average length of the shortest paths between different
+            nodes
+    """
+    off_diagonal = ~np.eye(len(distances), dtype=bool)
+    finite = off_diagonal & np.isfinite(distances)
+
+    return distances[finite].mean()
+
+
+def save_shortest_paths(path, distances, predecessors):
+    """
+    Saves the distance and predecessor matrices as .npy files. Distances
+    are stored as float32.
+
+    Args:
+        path (str): path prefix of the files, e.g. 
+            'data/processed/graphs/precovid_inverse_p'
+        distances (array): distance matrix from compute_shortest_paths
+        predecessors (array): predecessor matrix from 
+            compute_shortest_paths
+    """
+    np.save(path + '_distances.npy', distances.astype(np.float32))
+    np.save(path + '_predecessors.npy', predecessors)
+
+
+def load_shortest_paths(path, mmap_mode='r'):
+    """
+    Loads the distance and predecessor matrices saved with
+    save_shortest_paths.
+
+    Args:
+        path (str): path prefix of the files
+        mmap_mode (str, optional): memory-map mode of numpy.load. 
+            Defaults to 'r'.
+
+    Returns:
+        (array, array): distance and predecessor matrices
+    """
+    return (
+        np.load(path + '_distances.npy', mmap_mode=mmap_mode),
+        np.load(path + '_predecessors.npy', mmap_mode=mmap_mode))
+
+
+def shortest_paths_to_dataframe(graph, distances, predecessors):
+    """
+    Builds a dataframe with the length (number of nodes) and the 
+    distance of the shortest path of each pair of different nodes with 
+    a path. Paths are not included, see shortest_path.
+
+    Args:
+        graph (dict): graph from build_sparse_graph
+        distances (array): distance matrix from compute_shortest_paths
+        predecessors (array): predecessor matrix from 
+            compute_shortest_paths
+
+    Returns:
+        dataframe: with source, target, distance and len columns
+    """
+    lengths = compute_path_lengths(predecessors)
+    sources, targets = np.nonzero(lengths > 1)
+
+    return pd.DataFrame({
+        'source': graph['nodes'][sources], 'target': graph['nodes'][targets],
+        'distance': distances[sources, targets], 'len': lengths[sources, targets]})
+
+
+################################
+###### Centrality measures #####
+################################
+
+# Cache folder of the centrality measures
+centrality_cache_dir_default = 'data/processed/centralities/'
+
+# Graphs of the centrality workers, set once per process
+_centrality_graphs = {}
+
+
+def graph_hash(G, weight=None):
+    """
+    Computes a hash of the nodes and edges of a networkx graph and of 
+    the weight used, to identify results computed on it.
+
+    Args:
+        G (DiGraph): networkx graph
+        weight (str, optional): edge attribute used as length. Defaults
+            to None.
+
+    Returns:
+        str: hexadecimal hash
+    """
+    df_edges = nx.to_pandas_edgelist(G)
+    columns = ['source', 'target'] + ([weight] if weight is not None else [])
+    df_edges = df_edges[columns].astype({'source': str, 'target': str})
+    df_edges = df_edges.sort_values(['source', 'target'], ignore_index=True)
+
+    h = hashlib.sha256()
+    h.update(repr((weight, sorted(map(str, G.nodes)))).encode())
+    h.update(pd.util.hash_pandas_object(df_edges, index=False).values.tobytes())
+
+    return h.hexdigest()
+
+
+def init_centrality_worker(graphs):
+    """
+    Sets the graphs of a centrality worker process.
+
+    Args:
+        graphs (dict): networkx graph of each phase
+    """
+    global _centrality_graphs
+    _centrality_graphs = graphs
+
+
+def compute_centrality_batch(phase, centrality, metric, nodes):
+    """
+    Computes a centrality measure for a batch of nodes of a phase graph.
+    Betweenness returns the unnormalized contribution of the paths that
+    start in the batch nodes, closeness the value of the batch nodes.
+
+    Args:
+        phase (str): phase of the graph
+        centrality (str): 'betweenness' or 'closeness'
+        metric (str): edge attribute used as length, None for hops
+        nodes (list): batch nodes
+
+    Returns:
+        dict: value of each node
+    """
+    G = _centrality_graphs[phase]
+
+    if centrality == 'betweenness':
+        return nx.betweenness_centrality_subset(
+            G, sources=nodes, targets=list(G), normalized=False, weight=metric)
+
+    return {node: nx.closeness_centrality(G, u=node, distance=metric, wf_improved=True) for node in nodes}
+
+
+def compute_centralities(
+    graphs, metrics=(None, 'inverse_trips', 'geo_distance'), centralities=('closeness', 'betweenness'),
+    cache_dir=centrality_cache_dir_default, workers=None, batch_size=50):
+    """
+    Computes the closeness and betweenness centrality of the nodes of 
+    each phase graph with each metric, as nx.closeness_centrality 
+    (wf_improved) and nx.betweenness_centrality (normalized) do. The 
+    work is split in batches of nodes computed in a process pool.
+
+    Results are cached in cache_dir, keyed by a hash of the graph, the
+    metric and the centrality, so they are only computed once.
+
+    Args:
+        graphs (dict): networkx DiGraph of each phase
+        metrics (tuple of str, optional): edge attributes used as 
+            length, None for hops. Defaults to (None, 'inverse_trips', 
+            'geo_distance').
+        centralities (tuple of str, optional): centrality measures. 
+            Defaults to ('closeness', 'betweenness').
+        cache_dir (str, optional): cache folder. Defaults to 
+            centrality_cache_dir_default.
+        workers (int, optional): number of processes. Defaults to None,
+            which uses the number of CPUs.
+        batch_size (int, optional): nodes of each batch. Defaults to 50.
+
+    Returns:
+        dataframe: with phase, metric, centrality, node and value 
+            columns. Metric is 'hops' for None.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    dfs, pending = [], []
+    for phase, G in graphs.items():
+        for metric in metrics:
+            key = graph_hash(G, metric)
+            for centrality in centralities:
+                path = os.path.join(cache_dir, f'{centrality}_{key}.pkl')
+                if os.path.exists(path):
+                    dfs.append(pd.read_pickle(path).assign(phase=phase))
+                else:
+                    pending.append((phase, metric, centrality, path))
+
+    # Batches of nodes of the measures not cached
+    tasks = []
+    for phase, metric, centrality, _ in pending:
+        nodes = list(graphs[phase])
+        for start in range(0, len(nodes), batch_size):
+            tasks.append((phase, centrality, metric, nodes[start:start + batch_size]))
+
+    if tasks:
+        print(f'Computing {len(pending)} centrality measures in {len(tasks)} batches')
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_centrality_worker, initargs=(graphs,)) as executor:
+            results = list(executor.map(compute_centrality_batch, *zip(*tasks)))
+
+        # Join the batches of each measure
+        values = {}
+        for (phase, centrality, metric, _), result in zip(tasks, results):
+            total = values.setdefault((phase, metric, centrality), dict.fromkeys(graphs[phase], 0.0))
+            for node, value in result.items():
+                total[node] += value
+
+        for phase, metric, centrality, path in pending:
+            total = values[(phase, metric, centrality)]
+            n_nodes = len(total)
+
+            # Normalized betweenness of directed graphs
+            if (centrality == 'betweenness') and (n_nodes > 2):
+                total = {node: value / ((n_nodes - 1) * (n_nodes - 2)) for node, value in total.items()}
+
+            df = pd.DataFrame({
+                'metric': 'hops' if metric is None else metric, 'centrality': centrality,
+                'node': list(total), 'value': list(total.values())})
+            df.to_pickle(path)
+            dfs.append(df.assign(phase=phase))
+
+    if not dfs:
+        return pd.DataFrame(columns=['phase', 'metric', 'centrality', 'node', 'value'])
+
+    df = pd.concat(dfs, ignore_index=True)[['phase', 'metric', 'centrality', 'node', 'value']]
+
+    return df
@@ -0,0 +1,210 @@
+"""
+Functions to read the MITMA maestra files.
+"""
+
+# Imports
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+
+# Columns needed to compute the mobility tables
+maestra_1_keys = ['fecha', 'origen', 'destino', 'actividad_origen']
+maestra_1_values = ['viajes']
+maestra_2_keys = ['distrito', 'numero_viajes']
+maestra_2_values = ['personas']
+
+# Default memory limit of the partial sums in streaming mode (bytes)
+max_memory_default = 512 * 1024**2
+
+# Arrow types of the maestra columns. Region codes and labels are read as
+# dictionaries, which become pandas categoricals
+maestra_types = {
+    'fecha': pa.int64(),
+    'origen': pa.dictionary(pa.int32(), pa.string()),
+    'destino': pa.dictionary(pa.int32(), pa.string()),
+    'actividad_origen': pa.dictionary(pa.int32(), pa.string()),
+    'distrito': pa.dictionary(pa.int32(), pa.string()),
+    'numero_viajes': pa.dictionary(pa.int32(), pa.string()),
+    'viajes': pa.float64(),
+    'personas': pa.float64()}
+
+
+def maestra_csv_options(columns):
+    """
+    Builds the Arrow CSV options to read some columns of a pipe
+    separated MITMA file with the types of maestra_types.
+
+    Args:
+        columns (list of str): columns to read
+
+    Returns:
+        dict: read, parse and convert options of pyarrow.csv
+    """
+    return {
+        'read_options': pv.ReadOptions(use_threads=True),
+        'parse_options': pv.ParseOptions(delimiter='|'),
+        'convert_options': pv.ConvertOptions(
+            column_types={column: maestra_types[column] for column in columns},
+            include_columns=columns)}
+
+
+def share_region_categories(df):
+    """
+    Gives the origin and destination regions the same categories, so
+    they can be compared.
+
+    Args:
+        df (dataframe): with categorical region columns
+
+    Returns:
+        dataframe: df with the shared categories
+    """
+    if ('origen' in df.columns) and ('destino' in df.columns):
+        categories = df['origen'].cat.categories.union(df['destino'].cat.categories)
+        df['origen'] = df['origen'].cat.set_categories(categories)
+        df['destino'] = df['destino'].cat.set_categories(categories)
+
+    return df
+
+
+def read_maestra_arrow(path, columns):
+    """
+    Reads some columns of a pipe separated MITMA file with the
+    multithreaded Arrow CSV parser and the types of maestra_types.
+    Origin and destination regions get the same categories, so they can
+    be compared.
+
+    Args:
+        path (str): path of the file, gzip compressed or not
+        columns (list of str): columns to read
+
+    Returns:
+        dataframe: with categorical region codes and labels
+    """
+    table = pv.read_csv(path, **maestra_csv_options(columns))
+
+    return share_region_categories(table.to_pandas())
+
+
+def read_maestra_chunks(path, columns, chunksize):
+    """
+    Reads some columns of a pipe separated MITMA file in chunks of rows
+    with the streaming Arrow CSV reader and the types of maestra_types,
+    as read_maestra_arrow.
+
+    Args:
+        path (str): path of the file, gzip compressed or not
+        columns (list of str): columns to read
+        chunksize (int): number of rows of each chunk
+
+    Yields:
+        dataframe: rows of a chunk, with categorical region codes and
+            labels
+    """
+    reader = pv.open_csv(path, **maestra_csv_options(columns))
+    batches, n_rows = [], 0
+
+    for batch in reader:
+        batches.append(batch)
+        n_rows += batch.num_rows
+        while n_rows >= chunksize:
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            yield table.slice(0, chunksize).to_pandas()
+            rest = table.slice(chunksize)
+            batches, n_rows = rest.to_batches(), rest.num_rows
+
+    if n_rows:
+        yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+
+def read_maestra_chunked(path, keys, values, chunksize, max_memory=max_memory_default):
+    """
+    Reads a pipe separated MITMA file in chunks of rows, folding the
+    partial groupby sums of each chunk. The partial sums are folded
+    again each time their memory exceeds max_memory. Columns get the
+    types of a whole file read.
+
+    Args:
+        path (str): path of the file
+        keys (list of str): columns to group by
+        values (list of str): columns to sum
+        chunksize (int): number of rows of each chunk
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes. Defaults to max_memory_default.
+
+    Returns:
+        dataframe: with the sum of values for each group of keys
+    """
+    partials = []
+    partials_memory = 0
+
+    for chunk in read_maestra_chunks(path, keys + values, chunksize):
+        partial = chunk.groupby(keys, sort=False, observed=True)[values].sum()
+        partials.append(partial)
+        partials_memory += partial.memory_usage(deep=True).sum()
+
+        # Fold partial sums to keep memory bounded
+        if partials_memory > max_memory:
+            partials = [pd.concat(partials).groupby(level=keys, sort=False).sum()]
+            partials_memory = partials[0].memory_usage(deep=True).sum()
+            if partials_memory > max_memory:
+                raise MemoryError(
+                    f'Aggregated {path} needs {partials_memory} bytes, '
+                    f'more than the {max_memory} bytes limit')
+
+    if not partials:
+        df = pa.schema([(column, maestra_types[column]) for column in keys + values]).empty_table().to_pandas()
+    else:
+        df = pd.concat(partials).groupby(level=keys, sort=False).sum().reset_index()
+
+    # Chunks have their own categories
+    for column in keys:
+        if pa.types.is_dictionary(maestra_types[column]):
+            df[column] = df[column].astype('category')
+
+    return share_region_categories(df)
+
+
+def read_maestra_1(path, chunksize=None, max_memory=max_memory_default):
+    """
+    Reads a maestra_1 (trips) file. The whole file is read with the
+    Arrow parser, with categorical regions and activities. In streaming
+    mode, trips are summed by day, origin, destination and origin
+    activity.
+
+    Args:
+        path (str): path of the file
+        chunksize (int, optional): number of rows of each chunk to read
+            in streaming mode. Defaults to None, which reads the whole file.
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes in streaming mode. Defaults to max_memory_default.
+
+    Returns:
+        dataframe: maestra_1 data
+    """
+    if chunksize is None:
+        return read_maestra_arrow(path, maestra_1_keys + maestra_1_values)
+
+    return read_maestra_chunked(path, maestra_1_keys, maestra_1_values, chunksize, max_memory)
+
+
+def read_maestra_2(path, chunksize=None, max_memory=max_memory_default):
+    """
+    Reads a maestra_2 (population) file. The whole file is read with the
+    Arrow parser, with categorical regions and numbers of trips. In
+    streaming mode, people are summed by region and number of trips.
+
+    Args:
+        path (str): path of the file
+        chunksize (int, optional): number of rows of each chunk to read
+            in streaming mode. Defaults to None, which reads the whole file.
+        max_memory (int, optional): memory limit of the partial sums in
+            bytes in streaming mode. Defaults to max_memory_default.
+
+    Returns:
+        dataframe: maestra_2 data
+    """
+    if chunksize is None:
+        return read_maestra_arrow(path, maestra_2_keys + maestra_2_values)
+
+    return read_maestra_chunked(path, maestra_2_keys, maestra_2_values, chunksize, max_memory)
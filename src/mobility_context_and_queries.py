@@ -7,9 +7,12 @@ tables.
 # Imports
 import numpy as np
 import pandas as pd
-import geopandas as gpd
+from psycopg2 import sql
 
 from src.database_utils import *
+from src.parquet_cache import *
+from src.regions import *
+from src.zoning import *
 
 
 ############################################################### 
@@ -63,18 +66,229 @@ motiv_list = [
     ]
 
 # Load Catalunya MITMA layers
-df_mitma_abs_overlap = pd.read_csv('data/raw/overlap_mitma_abs.csv')
-mitma_layers_cat = df_mitma_abs_overlap.m_id.unique()
-mitma_layers_cat = [str(i).zfill(3) for i in mitma_layers_cat]
+df_mitma_abs_overlap = pd.read_csv('data/raw/overlap_mitma_abs.csv', dtype={'m_id': str})
+mitma_layers_cat = list(df_mitma_abs_overlap.m_id.unique())
 
 ############################################################### 
 ##################### Query and add data ######################
 ###############################################################
 
 
+def location_codes(
+    municipality=None, province=None, municipalities_groups=None, 
+    province_groups=None):
+    """
+    Gets the MITMA codes used to filter by location. Municipalities and
+    provinces are matched as prefixes of the MITMA codes. Only the first
+    filter set is used.
+
+    Args:
+        municipality (str, optional): MITMA code of a municipality. 
+            Defaults to None.
+        province (str, optional): MITMA code of a province. Defaults to 
+            None.
+        municipalities_groups (list of str, optional): MITMA codes of 
+            multiple municipalities. Defaults to None.
+        province_groups (list of tuple, optional): items of location_info
+            with the province codes. Defaults to None.
+
+    Returns:
+        (list of str, bool, bool): MITMA codes or code prefixes, True if 
+            they are prefixes and True if both source and target regions
+            must be inside the location. None if no filter is set.
+    """
+    if municipality is not None:
+        # Both regions inside the municipality
+        return [municipality], True, True
+    elif province is not None:
+        return [province], True, False
+    elif municipalities_groups is not None:
+        return list(municipalities_groups), False, False
+    elif province_groups is not None:
+        return [mg[1][0] for mg in province_groups if mg[1][0] is not None], True, False
+
+    return None
+
+
+def location_filter(
+    municipality=None, province=None, municipalities_groups=None, 
+    province_groups=None, filter_target=True):
+    """
+    Compiles the location filters into a parameterized sql condition
+    on the source (and target) region ids. Municipalities and provinces
+    are filtered as id ranges.
+
+    Args:
+        municipality (str, optional): MITMA code of a municipality. 
+            Defaults to None.
+        province (str, optional): MITMA code of a province. Defaults to 
+            None.
+        municipalities_groups (list of str, optional): MITMA codes of 
+            multiple municipalities. Defaults to None.
+        province_groups (list of tuple, optional): items of location_info
+            with the province codes. Defaults to None.
+        filter_target (bool, optional): True also filters the target 
+            regions. Defaults to True.
+
+    Returns:
+        (str, dict): sql condition and its parameters. The condition is 
+            None if no filter is set.
+    """
+    location = location_codes(
+        municipality, province, municipalities_groups, province_groups)
+    if location is None:
+        return None, {}
+
+    codes, is_prefix, match_all = location
+    columns = ['source', 'target'] if filter_target else ['source']
+
+    if is_prefix:
+        parameters = {}
+        ranges = []
+        for i, (first, last) in enumerate(prefix_id_ranges(codes)):
+            parameters.update({f'location_first_{i}': first, f'location_last_{i}': last})
+            ranges.append(f"BETWEEN %(location_first_{i})s AND %(location_last_{i})s")
+        conditions = [
+            '(' + ' OR '.join(f"{column} {id_range}" for id_range in ranges) + ')'
+            if ranges else 'FALSE' for column in columns]
+    else:
+        parameters = {'location': encode_regions(codes, strict=False).tolist()}
+        conditions = [f"{column} = ANY(%(location)s)" for column in columns]
+
+    operator = ' AND ' if match_all else ' OR '
+    condition = '(' + operator.join(conditions) + ')'
+
+    return condition, parameters
+
+
+# SQL aggregate functions allowed in build_query, by pandas name
+aggregate_functions = {
+    'sum': 'SUM', 'mean': 'AVG', 'avg': 'AVG', 'min': 'MIN', 'max': 'MAX',
+    'count': 'COUNT'}
+
+
+def build_query(
+    table, columns=None, date1=None, date2=None, regions=None, 
+    municipality=None, province=None, municipalities_groups=None, 
+    province_groups=None, filter_target=True, filters=None, group_by=None, 
+    aggregates=None, order_by=None):
+    """
+    Builds a parameterized sql query on a MITMA table. Table and column
+    names are quoted as identifiers and values are passed as query
+    parameters, so selections, filters and aggregations run in the 
+    database.
+
+    Args:
+        table (str): name of the table
+        columns (list of str, optional): columns to select. Defaults to
+            None, which selects all of them. Ignored if there are 
+            aggregates.
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults 
+            to None, which leaves the start open.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults 
+            to None, which leaves the end open.
+        regions (list of str, optional): source regions, e.g. 
+            mitma_layers_cat. Defaults to None.
+        municipality (str, optional): MITMA code of a municipality to 
+            filter the query. Defaults to None.
+        province (str, optional): MITMA codes of a province to filter
+            the query. Defaults to None.
+        municipalities_groups (list of str, optional): MITMA codes of 
+            multiple municipalities to filter the query. Defaults to None.
+        province_groups (list of str, optional): MITMA codes of multiple
+            provinces to filter the query. Defaults to None.
+        filter_target (bool, optional): True also filters the target 
+            regions by location. Defaults to True.
+        filters (dict, optional): values of other columns to keep, e.g.
+            {'period': ['lockdown']}. Defaults to None.
+        group_by (list of str, optional): columns to group by. Defaults
+            to None.
+        aggregates (dict, optional): (column, function) of each output 
+            column, as in pandas named aggregations, e.g. 
+            {'trips': ('trips', 'sum')}. Functions are the keys of 
+            aggregate_functions and column '*' counts rows. Defaults to
+            None.
+        order_by (list of str, optional): columns to sort by. Defaults 
+            to None.
+
+    Returns:
+        (sql.Composed, dict): query and its parameters
+    """
+    parameters = {}
+    conditions = []
+
+    if regions is not None:
+        conditions.append(sql.SQL("source = ANY(%(regions)s)"))
+        parameters['regions'] = encode_regions(regions, strict=False).tolist()
+
+    location, location_parameters = location_filter(
+        municipality, province, municipalities_groups, province_groups, 
+        filter_target)
+    if location is not None:
+        conditions.append(sql.SQL(location))
+        parameters.update(location_parameters)
+
+    conditions += [sql.SQL(condition) for condition in date_conditions(date1, date2)]
+    parameters.update({'date1': date1, 'date2': date2})
+
+    for i, (column, values) in enumerate((filters or {}).items()):
+        conditions.append(sql.SQL("{} = ANY({})").format(
+            sql.Identifier(column), sql.Placeholder(f'filter_{i}')))
+        parameters[f'filter_{i}'] = list(values)
+
+    # Selected columns
+    group_by = list(group_by or [])
+    if aggregates:
+        selection = [sql.Identifier(column) for column in group_by]
+        for name, (column, function) in aggregates.items():
+            if function not in aggregate_functions:
+                raise ValueError(f'Unknown aggregate function {function}')
+            argument = sql.SQL('*') if column == '*' else sql.Identifier(column)
+            selection.append(sql.SQL("{}({}) AS {}").format(
+                sql.SQL(aggregate_functions[function]), argument, sql.Identifier(name)))
+    elif columns is not None:
+        selection = [sql.Identifier(column) for column in columns]
+    else:
+        selection = [sql.SQL('*')]
+
+    query = sql.SQL("SELECT {} FROM {}").format(
+        sql.SQL(', ').join(selection), sql.Identifier(table))
+    if conditions:
+        query += sql.SQL(" WHERE ") + sql.SQL(' AND ').join(conditions)
+    if group_by:
+        query += sql.SQL(" GROUP BY ") + sql.SQL(', ').join(map(sql.Identifier, group_by))
+    if order_by:
+        query += sql.SQL(" ORDER BY ") + sql.SQL(', ').join(map(sql.Identifier, order_by))
+
+    return query, parameters
+
+
+def query_table(table, decode=True, **kwargs):
+    """
+    Queries a MITMA table with a query from build_query.
+
+    Args:
+        table (str): name of the table
+        decode (bool, optional): False to keep the region ids instead of
+            the MITMA codes. Defaults to True.
+        **kwargs: columns, dates, region filters, group by columns, 
+            aggregates and order of build_query
+
+    Returns:
+        dataframe: query result
+    """
+    df = query_dataframe(*build_query(table, **kwargs))
+    if decode:
+        for column in ['source', 'target']:
+            if column in df.columns:
+                df[column] = decode_regions(df[column].values)
+
+    return df
+
+
 def query_raw_data_or_trips_or_flux_matrix_between_dates(
     table, date1=None, date2=None, municipality=None, province=None, 
-    municipalities_groups=None, province_groups=None):
+    municipalities_groups=None, province_groups=None, cache_dir=None):
     """
     Queries data to mitma_raw_data, mitma_trips_matrix, or mitma_flux 
     tables. It can be filtered by location and by date.
@@ -93,47 +307,41 @@ def query_raw_data_or_trips_or_flux_matrix_between_dates(
             multiple municipalities to filter the query. Defaults to None.
         province_groups (list of str, optional): MITMA codes of multiple
             provinces to filter the query. Defaults to None.
+        cache_dir (str, optional): folder of the Parquet cache. If the 
+            days of the table are cached there, they are read from disk
+            instead of the database. Defaults to None.
 
     Returns:
         dataframe: query result.
     """
-    df = pd.DataFrame()
+    # Filter data by location postal code
+    if location_codes(
+            municipality, province, municipalities_groups, province_groups) is None:
+        print('Set city or province')
+        return pd.DataFrame()
+
+    # Read MITMA data from the Parquet cache
+    if (cache_dir is not None) and is_table_cached(table, cache_dir, date1, date2):
+        print(f"Reading {table} data from {cache_dir}")
+        codes, is_prefix, match_all = location_codes(
+            municipality, province, municipalities_groups, province_groups)
+        df = read_table_from_parquet(
+            table, date1, date2, regions=mitma_layers_cat, 
+            location=location_expression(codes, is_prefix, match_all, ('source', 'target')), 
+            cache_dir=cache_dir)
 
     # Query MITMA data
-    if date1 is not None:
-        print(f"Querying {table} data from {date1} to {date2}")
-        query = f"SELECT * FROM {table} \
-                  WHERE source = ANY(%(parameter_array)s) \
-                  AND datetime between '{date1}' and '{date2}'"
     else:
-        print(f"Querying all {table} data")
-        query = f"SELECT * FROM {table} \
-                  WHERE source = ANY(%(parameter_array)s)"
+        if date1 is not None:
+            print(f"Querying {table} data from {date1} to {date2}")
+        else:
+            print(f"Querying all {table} data")
 
-    df_query = query_parameters_cat(query, mitma_layers_cat)
-    
-    # Filter data by location postal code
-    if municipality is not None:
-        df = df.append(df_query[
-            (df_query['source'].str[:5] == municipality) & 
-            (df_query['target'].str[:5] == municipality)])    
-    elif province is not None:
-        df = df.append(df_query[
-            (df_query['source'].str[:2] == province) | 
-            (df_query['target'].str[:2] == province)])
-    elif municipalities_groups is not None:
-        for postal_code in municipalities_groups:
-            df = df.append(df_query[
-                (df_query['source'] == postal_code) | 
-                (df_query['target'] == postal_code)])
-    elif province_groups is not None:
-        for mg in province_groups:
-            postal_code = mg[1][0]
-            df = df.append(df_query[
-                (df_query['source'].str[:2] == postal_code) | 
-                (df_query['target'].str[:2] == postal_code)])
-    else:
-        print('Set city or province')
+        df = query_table(
+            table, date1=date1, date2=date2, regions=mitma_layers_cat, 
+            municipality=municipality, province=province, 
+            municipalities_groups=municipalities_groups, 
+            province_groups=province_groups)
 
     # Set datetime and drop column
     if table == 'mitma_cat_raw':
@@ -143,14 +351,14 @@ def query_raw_data_or_trips_or_flux_matrix_between_dates(
         df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
     else:
         df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
-        df.drop(['parameter_id'], axis=1, inplace=True)
+        df.drop(['parameter_id'], axis=1, inplace=True, errors='ignore')
     
     return df
 
 
 def query_trips_iio_or_qrp_between_dates(
     table, date1=None, date2=None, municipality=None, 
-    province=None, municipalities_groups=None, province_groups=None):
+    province=None, municipalities_groups=None, province_groups=None, cache_dir=None):
     """
     Queries data to mitma_raw_data, mitma_trips_matrix, or mitma_flux 
     tables. It can be filtered by location and by date.
@@ -169,41 +377,43 @@ def query_trips_iio_or_qrp_between_dates(
             multiple municipalities to filter the query. Defaults to None.
         province_groups (list of str, optional): MITMA codes of multiple
             provinces to filter the query. Defaults to None.
+        cache_dir (str, optional): folder of the Parquet cache. If the 
+            days of the table are cached there, they are read from disk
+            instead of the database. Defaults to None.
 
     Returns:
         dataframe: query result.
     """       
-    df = pd.DataFrame()
+    # Filter data by location postal code
+    if location_codes(
+            municipality, province, municipalities_groups, province_groups) is None:
+        print('Set city or province')
+        return pd.DataFrame()
+
+    # Read MITMA data from the Parquet cache
+    if (cache_dir is not None) and is_table_cached(table, cache_dir, date1, date2):
+        print(f"Reading {table} data from {cache_dir}")
+        codes, is_prefix, match_all = location_codes(
+            municipality, province, municipalities_groups, province_groups)
+        df = read_table_from_parquet(
+            table, date1, date2, regions=mitma_layers_cat, 
+            location=location_expression(codes, is_prefix, match_all, ('source',)), 
+            cache_dir=cache_dir)
+        df = df.sort_values('datetime', kind='stable')
 
     # Query MITMA data
-    if date1 is not None:
-        print(f"Querying {table} data from {date1} to {date2}")
-        query = f"SELECT * FROM {table} \
-                  WHERE source = ANY(%(parameter_array)s) \
-                  AND datetime between '{date1}' and '{date2}' \
-                  ORDER BY datetime ASC"
-    else:
-        print(f"Querying all {table} data")
-        query = f"SELECT * FROM {table} \
-                  WHERE source = ANY(%(parameter_array)s) \
-                  ORDER BY datetime ASC"
-
-    df_query = query_parameters_cat(query, mitma_layers_cat)
-    
-    # Filter data by location postal code
-    if municipality is not None:
-        df = df.append(df_query[df_query['source'].str[:5] == municipality])  
-    elif province is not None:
-        df = df.append(df_query[df_query['source'].str[:2] == province])
-    elif municipalities_groups is not None:
-        for postal_code in municipalities_groups:
-            df = df.append(df_query[df_query['source'] == postal_code])
-    elif province_groups is not None:
-        for mg in province_groups:
-            postal_code = mg[1][0]
-            df = df.append(df_query[df_query['source'].str[:2] == postal_code])
     else:
-        print('Set city or province')
+        if date1 is not None:
+            print(f"Querying {table} data from {date1} to {date2}")
+        else:
+            print(f"Querying all {table} data")
+
+        df = query_table(
+            table, date1=date1, date2=date2, regions=mitma_layers_cat, 
+            municipality=municipality, province=province, 
+            municipalities_groups=municipalities_groups, 
+            province_groups=province_groups, filter_target=False, 
+            order_by=['datetime'])
     
     # Set datetime column
     df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d')
@@ -217,24 +427,19 @@ def query_trips_iio_or_qrp_between_dates(
         df.columns = ['datetime', 'source', 'internal', 'incoming', 
             'outcoming', 'total']
     else:
-        df = df.drop(columns=['parameter_id'])
+        df = df.drop(columns=['parameter_id'], errors='ignore')
         df['m'] = 1 - df['q']
 
         # Set datetime
         df.set_index('datetime', inplace=True)
         df['weekday'] = df.index.weekday
 
-        # Add geopandas data to each source
-        # Filter Catalunya MITMA zones
-        mitma_gpd = gpd.read_file('../../data_1TB/MITMA/zonificación/distritos_mitma.shp')
-        mitma_gpd_cat = mitma_gpd[
-            (mitma_gpd['ID'].str[:2] == '25') | (mitma_gpd['ID'].str[:2] == '08') |
-            (mitma_gpd['ID'].str[:2] == '17') | (mitma_gpd['ID'].str[:2] == '43')]
+        # Add geopandas data to each source from the cached MITMA zones
+        mitma_gpd = zoning_regions(regions=df['source'].unique())
 
         # Join mqrp parameters with MITMA zones
-        df = mitma_gpd.set_index('ID').join(df.reset_index().set_index(
-            'source')).reset_index()
-        df.rename(columns = {'index':'source'}, inplace = True)
+        df = mitma_gpd[['ID', 'geometry']].rename(columns={'ID': 'source'}).merge(
+            df.reset_index(), on='source', how='inner')
         df = df.dropna()
 
         # Reorder columns
@@ -244,53 +449,194 @@ def query_trips_iio_or_qrp_between_dates(
     return df
 
 
-def add_phases_and_motivs(df, phases_list, motiv_list):
+def store_phases_and_motivs(phases_list=phases_list, motiv_list=motiv_list):
     """
-    Adds a phase and a motiv columns to a mitma_qrp dataframe
+    Stores the phases and motivs in the mitma_periods table and computes
+    the mean trips and mean p of each pair of MITMA regions in each of
+    them (mitma_period_means table). Only new periods or periods with 
+    new dates are computed; later ingestions refresh the periods that 
+    include the new days.
 
     Args:
-        df (dataframe): which corresponds to the result of a mitma_qrp table
-        phases_list (list of dict): dict with format 
-            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}
-        motiv_list (list of dict): dict with format 
-            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}
+        phases_list (list of dict, optional): dict with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}. Defaults to
+            phases_list.
+        motiv_list (list of dict, optional): dict with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}. Defaults to
+            motiv_list.
+    """
+    periods = []
+    for period_type, period_list in [('phase', phases_list), ('motiv', motiv_list)]:
+        for period in period_list:
+            for period_name, period_dates in period.items():
+                periods.append(
+                    (period_name, period_type, period_dates['start'], period_dates['end']))
+
+    store_periods(periods)
+
+
+def query_period_means(
+    periods=None, municipality=None, province=None, municipalities_groups=None, 
+    province_groups=None):
+    """
+    Queries the mean trips and mean p of each pair of MITMA regions in 
+    each phase or motiv (mitma_period_means table), instead of the
+    daily matrices of the whole study. It can be filtered by location 
+    and by period.
+
+    Args:
+        periods (list of str, optional): names of the phases or motivs.
+            Defaults to None, which returns all of them.
+        municipality (str, optional): MITMA code of a municipality to 
+            filter the query. Defaults to None.
+        province (str, optional): MITMA codes of a province to filter
+            the query. Defaults to None.
+        municipalities_groups (list of str, optional): MITMA codes of 
+            multiple municipalities to filter the query. Defaults to None.
+        province_groups (list of str, optional): MITMA codes of multiple
+            provinces to filter the query. Defaults to None.
+
+    Returns:
+        dataframe: with period, source, target, trips, trips_days, p and
+            p_days columns.
+    """
+    # Filter data by location postal code
+    if location_codes(
+            municipality, province, municipalities_groups, province_groups) is None:
+        print('Set city or province')
+        return pd.DataFrame()
+
+    return query_table(
+        'mitma_period_means', regions=mitma_layers_cat, municipality=municipality, 
+        province=province, municipalities_groups=municipalities_groups, 
+        province_groups=province_groups, 
+        filters=None if periods is None else {'period': periods}, 
+        order_by=['period', 'source', 'target'])
+
+
+def compile_calendar(calendar):
+    """
+    Compiles a calendar of phases or motivs into sorted elementary 
+    intervals, so dates can be labelled with a single searchsorted. 
+    Calendar entries can overlap; as with sequential assignments, the 
+    last entry covering a date sets its label.
+
+    Args:
+        calendar (list of dict): dict with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}. Start and 
+            end dates are included.
+
+    Returns:
+        (array, array, list of str): sorted interval bounds in 
+            nanoseconds, label code of each interval (-1 without label)
+            and labels.
+    """
+    entries = [
+        (name, dates['start'], dates['end'])
+        for period in calendar for name, dates in period.items()]
+    labels = list(dict.fromkeys(name for name, _, _ in entries))
+
+    starts = pd.to_datetime([start for _, start, _ in entries]).values.astype('datetime64[ns]').view('int64')
+    ends = pd.to_datetime([end for _, _, end in entries]).values.astype('datetime64[ns]').view('int64') + 1
+    bounds = np.unique(np.concatenate([starts, ends]))
+
+    # Label of each interval [bounds[i], bounds[i + 1])
+    codes = np.full(len(bounds), -1)
+    for (name, _, _), start, end in zip(entries, starts, ends):
+        codes[np.searchsorted(bounds, start):np.searchsorted(bounds, end)] = labels.index(name)
+
+    return bounds, codes, labels
+
+
+def label_dates(dates, calendar):
+    """
+    Labels dates with the phases or motivs of a calendar.
+
+    Args:
+        dates (DatetimeIndex or datetime series): dates to label
+        calendar (list of dict or tuple): calendar with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}} or the result
+            of compile_calendar
+
+    Returns:
+        categorical: label of each date, '' if it isn't in the calendar
+    """
+    bounds, codes, labels = calendar if isinstance(calendar, tuple) else compile_calendar(calendar)
+
+    # Interval of each date. Dates before the first bound get the -1 
+    # code prepended to the interval codes
+    dates = np.asarray(dates, dtype='datetime64[ns]').view('int64')
+    date_codes = np.concatenate([[-1], codes])[np.searchsorted(bounds, dates, side='right')]
+
+    # Dates without label get the '' category
+    date_codes = np.where(date_codes == -1, len(labels), date_codes)
+
+    return pd.Categorical.from_codes(date_codes, categories=labels + [''])
+
+
+def add_phases_and_motivs(df, phases_list=phases_list, motiv_list=motiv_list):
+    """
+    Adds a phase and a motiv categorical columns to a mitma_qrp 
+    dataframe. Phases and motivs can overlap, the last one in each list 
+    sets the label.
+
+    Args:
+        df (dataframe): which corresponds to the result of a mitma_qrp 
+            table, with a datetime index
+        phases_list (list of dict, optional): dict with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}. Defaults to
+            phases_list.
+        motiv_list (list of dict, optional): dict with format 
+            {'name':{'start':'%Y-%m-%d','end':'%Y-%m-%d'}}. Defaults to
+            motiv_list.
 
     Returns:
         dataframe: mitma_qrp dataframe with phase and motiv columns
     """
-    # Geopandas dataframe to pandas dataframe to allow datetime comparisons
-    if 'geometry' in df.columns:
-        df_geometry = df['geometry']
-        df = df[['source', 'weekday', 'q', 'r', 'p', 'm']]
-
-    # Add columns
-    df['phase'], df['motiv']  = '', ''
-
-    # Add phases according to dates
-    for phase in phases_list:
-        for phase_name, phase_dates in phase.items():
-            start, end = phase_dates['start'], phase_dates['end'] 
-            df.loc[(df.index >= start) & (df.index <= end), 'phase'] = phase_name
-
-    # Add motivs according to dates
-    for motiv in motiv_list:
-        for motiv_name, motiv_dates in motiv.items():
-            start, end = motiv_dates['start'], motiv_dates['end'] 
-            df.loc[(df.index >= start) & (df.index <= end), 'motiv'] = motiv_name
-
-    # Add geopandas column again
-    df['geometry'] = df_geometry
-    
+    df = df.assign(
+        phase=label_dates(df.index, phases_list), 
+        motiv=label_dates(df.index, motiv_list))
+
     # Reorder columns
-    df = df[['source', 'weekday', 'phase', 'motiv', 'q', 'r', 'p', 'm', 'geometry']]
+    columns = ['source', 'weekday', 'phase', 'motiv', 'q', 'r', 'p', 'm', 'geometry']
+    df = df[[column for column in columns if column in df.columns]]
     
     return df
 
 
+# Flux of each trip for its region: internal, outgoing or incoming
+flux_columns = ['internal', 'outcoming', 'incoming']
+
+
+def finish_fluxes(merged, by_hour=False):
+    """
+    Adds the total trips of each region and, by hour, the datetime-hour
+    column to the fluxes of compute_fluxes_by_area and
+    query_fluxes_by_area.
+
+    Args:
+        merged (dataframe): with datetime, (hour,) source, internal,
+            outcoming and incoming columns
+        by_hour (bool, optional): True if the fluxes are hourly.
+            Defaults to False.
+
+    Returns:
+        dataframe: merged with the total (and datetime-hour) columns
+    """
+    merged['datetime'] = pd.to_datetime(merged['datetime'])
+    if by_hour:
+        merged['datetime-hour'] = merged['datetime'] + pd.to_timedelta(merged['hour'], unit='h')
+    merged['total'] = merged['internal'] + merged['outcoming'] + merged['incoming']
+
+    return merged
+
+
 def compute_fluxes_by_area(df, by_hour=False):
     """
     Computes trip fluxes (incoming, outgoing and internal) from a 
-    mitma_raw_cat query dataframe.
+    mitma_raw_cat query dataframe, in a single groupby. Each trip 
+    counts for its source region, as internal or outgoing, and trips 
+    to another region count again as incoming for the target region.
 
     Args:
         df (dataframe): which corresponds to the result of a mitma_raw_cat
@@ -302,70 +648,94 @@ def compute_fluxes_by_area(df, by_hour=False):
         set(dataframe): set of 4 dataframes. Internal trips, outcoming trips, 
             incoming trips and a last daframe with all three merged.  
     """
-    
-    if by_hour:
-        internal = df[df.target == df.source].groupby(
-            ['datetime', 'source', 'target', 'hour']).sum().reset_index()
-        outcoming = df.groupby(['datetime', 'hour', 'source']).sum().reset_index()
-        incoming = df.groupby(['datetime', 'hour', 'target']).sum().reset_index()
-        
-        merged = outcoming.merge(
-            incoming, left_on=['datetime', 'source', 'hour'], 
-            right_on=['datetime', 'target', 'hour'], how='outer')[[
-                'datetime', 'hour', 'source', 'target', 'trips_x', 'trips_y']]
-
-        merged.source.fillna(merged.target, inplace=True)
-        merged.drop(columns='target', inplace=True)
-        merged.rename(
-            columns={'source':'patch', 'trips_x': 'outcoming', 'trips_y':'incoming'},
-            inplace=True)
-        
-        merged = merged.merge(
-            internal, left_on = ['datetime', 'patch', 'hour'], 
-            right_on=['datetime', 'source', 'hour'], how='outer')[[
-                'datetime', 'hour', 'patch', 'target', 
-                'trips', 'outcoming', 'incoming']]
-        
-    else:
-        internal = df[df.target == df.source].groupby(
-            ['datetime', 'source', 'target']).sum().reset_index()
-        outcoming = df.groupby(['datetime', 'source']).sum().reset_index()
-        incoming = df.groupby(['datetime', 'target']).sum().reset_index()
-
-        merged = outcoming.merge(
-            incoming, left_on=['datetime', 'source'], 
-            right_on=['datetime', 'target'], how='outer')[[
-                'datetime', 'source', 'target', 'trips_x', 'trips_y']]
-
-        merged.source.fillna(merged.target, inplace=True)
-        merged.drop(columns='target', inplace=True)
-        merged.rename(
-            columns={'source':'patch', 'trips_x': 'outcoming', 'trips_y':'incoming'},
-            inplace=True)
-
-        merged = merged.merge(
-            internal, left_on = ['datetime', 'patch'], right_on=['datetime', 'source'], 
-            how='outer')[['datetime', 'patch', 'target', 'trips', 'outcoming', 'incoming']]
-        merged.drop(columns='target', inplace=True)
-
-    merged = merged.fillna(0)
-
-    # Set datetime format
-    merged['datetime-hour'] = pd.to_datetime(
-        merged['datetime'].astype(str) + ' ' + merged['hour'].astype(str).str.zfill(2),
-        format='%Y%m%d %H')
-
-    # Compute final columns
-    merged['outcoming'] =  merged['outcoming'] - merged['trips']
-    merged['incoming'] =  merged['incoming'] - merged['trips']
-    merged.rename(columns={'trips':'internal'}, inplace=True)
-    merged['total'] = merged['internal'] + merged['outcoming'] + merged['incoming'] 
-
-    merged = merged.rename(columns={'patch': 'source'})
-        
+    keys = ['datetime', 'hour'] if by_hour else ['datetime']
+    other = (df['source'] != df['target']).values
+
+    # One row for the source region of each trip and another for the
+    # target region of the trips to other regions
+    rows = {key: np.concatenate([df[key].values, df[key].values[other]]) for key in keys}
+    rows['source'] = np.concatenate([
+        np.asarray(df['source'], dtype=object), np.asarray(df['target'], dtype=object)[other]])
+    rows['flux'] = np.concatenate([other.astype(np.int8), np.full(other.sum(), 2, dtype=np.int8)])
+    rows['trips'] = np.concatenate([df['trips'].values, df['trips'].values[other]])
+
+    merged = pd.DataFrame(rows).groupby(keys + ['source', 'flux']).trips.sum().unstack(
+        fill_value=0).reindex(columns=[0, 1, 2], fill_value=0)
+    merged.columns = flux_columns
+    merged = finish_fluxes(merged.reset_index(), by_hour)
+
+    internal, outcoming, incoming = [
+        merged[keys + ['source', column]] for column in flux_columns]
+
     return internal, outcoming, incoming, merged
 
 
+def query_fluxes_by_area(
+    date1=None, date2=None, by_hour=False, municipality=None, province=None, 
+    municipalities_groups=None, province_groups=None):
+    """
+    Computes the trip fluxes of compute_fluxes_by_area in the database,
+    with a single scan of the mitma_cat_raw table, so the raw hourly 
+    rows are not transferred. Trips are filtered by location and date 
+    as in query_raw_data_or_trips_or_flux_matrix_between_dates.
+
+    Args:
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults 
+            to None.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults 
+            to None.
+        by_hour (bool, optional): True returns fluxes grouped hourly, 
+            false daily. Defaults to False.
+        municipality (str, optional): MITMA code of a municipality to 
+            filter the query. Defaults to None.
+        province (str, optional): MITMA codes of a province to filter
+            the query. Defaults to None.
+        municipalities_groups (list of str, optional): MITMA codes of 
+            multiple municipalities to filter the query. Defaults to None.
+        province_groups (list of str, optional): MITMA codes of multiple
+            provinces to filter the query. Defaults to None.
+
+    Returns:
+        dataframe: internal, outcoming, incoming and total trips of each
+            region and day (and hour)
+    """
+    location, parameters = location_filter(
+        municipality, province, municipalities_groups, province_groups)
+    if location is None:
+        print('Set city or province')
+        return pd.DataFrame()
+
+    keys = sql.SQL(', ').join(map(sql.Identifier, ['datetime', 'hour'] if by_hour else ['datetime']))
+    conditions = [
+        sql.SQL("(flux.kind < 2 OR source <> target)"), sql.SQL("source = ANY(%(parameter_array)s)"),
+        sql.SQL(location)]
+    conditions += [sql.SQL(condition) for condition in date_conditions(date1, date2)]
+    parameters.update({
+        'parameter_array': encode_regions(mitma_layers_cat, strict=False).tolist(),
+        'date1': date1, 'date2': date2})
+
+    if (date1 is not None) or (date2 is not None):
+        print(f"Querying mitma_cat_raw fluxes from {date1} to {date2}")
+    else:
+        print("Querying all mitma_cat_raw fluxes")
+    query = sql.SQL("""
+        SELECT {keys}, flux.region AS source,
+            coalesce(sum(trips) FILTER (WHERE flux.kind = 0), 0) AS internal,
+            coalesce(sum(trips) FILTER (WHERE flux.kind = 1), 0) AS outcoming,
+            coalesce(sum(trips) FILTER (WHERE flux.kind = 2), 0) AS incoming
+        FROM mitma_cat_raw CROSS JOIN LATERAL (VALUES
+            (source, CASE WHEN source = target THEN 0 ELSE 1 END),
+            (target, 2)) AS flux(region, kind)
+        WHERE {conditions}
+        GROUP BY {keys}, flux.region ORDER BY {keys}, flux.region""").format(
+        keys=keys, conditions=sql.SQL(' AND ').join(conditions))
+
+    merged = query_dataframe(query, parameters)
+    merged['source'] = decode_regions(merged['source'].values)
+
+    return finish_fluxes(merged, by_hour)
+
+
 def set_id(df):
     """
     Creates a column with the MITMA region corresponding to a 
@@ -0,0 +1,356 @@
+"""
+Functions to store the daily OD matrices of the mitma_trips_matrix and
+mitma_flux tables as a memory-mapped (days x regions x regions) float32
+array, one file per table. The metadata keeps the MITMA code and the
+id in the regions dictionary of each region of the array. Phase means,
+weekly sums or single days are NumPy reductions over the array.
+"""
+
+# Imports
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from src.database_utils import query_dataframe, date_conditions
+from src.regions import load_regions
+
+# Store folder
+od_store_dir_default = 'data/processed/od_tensors/'
+
+# Value stored for each table
+od_values = {'mitma_trips_matrix': 'trips', 'mitma_flux': 'p'}
+
+# Type of the stored values. Pairs without rows in a day are NaN
+od_dtype = np.float32
+
+
+def od_store_paths(table, store_dir=od_store_dir_default):
+    """
+    Gets the paths of the array and the metadata of a table.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+
+    Returns:
+        (str, str): paths of the array and the metadata files
+    """
+    return (
+        os.path.join(store_dir, table + '.dat'),
+        os.path.join(store_dir, table + '.json'))
+
+
+def create_od_store(table, regions, store_dir=od_store_dir_default, ids=None):
+    """
+    Creates an empty store for a table. The position of each region in
+    the array is its position in regions and never changes. Regions
+    added later to the dictionary are added to the store by
+    grow_od_store.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        regions (list of str): MITMA codes of the regions
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+        ids (list of int, optional): id of each region in the regions
+            dictionary, to append days with region ids. Defaults to
+            None, which only accepts MITMA codes.
+    """
+    path, metadata_path = od_store_paths(table, store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    open(path, 'wb').close()
+    metadata = {
+        'table': table, 'value': od_values[table], 'dtype': np.dtype(od_dtype).name,
+        'regions': [str(region) for region in regions],
+        'ids': None if ids is None else [int(i) for i in ids], 'days': []}
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f)
+
+
+def read_od_metadata(table, store_dir=od_store_dir_default):
+    """
+    Reads the metadata of a table store.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+
+    Returns:
+        dict: table, value, dtype, regions, ids and days (format
+            %Y-%m-%d) of the store
+    """
+    _, metadata_path = od_store_paths(table, store_dir)
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def region_index(metadata, codes):
+    """
+    Gets the positions of MITMA regions in the array.
+
+    Args:
+        metadata (dict): store metadata from read_od_metadata
+        codes (list of str): MITMA codes
+
+    Returns:
+        array: position of each region
+    """
+    ids = pd.Index(metadata['regions']).get_indexer([str(code) for code in codes])
+    if (ids == -1).any():
+        missing = [code for code, i in zip(codes, ids) if i == -1]
+        raise KeyError(f"Regions not in the {metadata['table']} store: {missing[:10]}")
+
+    return ids
+
+
+def region_codes(metadata, ids):
+    """
+    Gets the MITMA codes of positions in the array.
+
+    Args:
+        metadata (dict): store metadata from read_od_metadata
+        ids (list of int): positions of the regions
+
+    Returns:
+        array: MITMA code of each id
+    """
+    return np.asarray(metadata['regions'])[np.asarray(ids)]
+
+
+def open_od_tensor(table, store_dir=od_store_dir_default, mode='r'):
+    """
+    Opens the memory-mapped array of a table store.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+        mode (str, optional): 'r' to read or 'r+' to modify the stored
+            days. Defaults to 'r'.
+
+    Returns:
+        (array, dict): (days x regions x regions) array and metadata
+    """
+    path, _ = od_store_paths(table, store_dir)
+    metadata = read_od_metadata(table, store_dir)
+    n_regions = len(metadata['regions'])
+    shape = (len(metadata['days']), n_regions, n_regions)
+
+    # Memory maps can't be empty
+    if shape[0] == 0:
+        return np.empty(shape, dtype=metadata['dtype']), metadata
+
+    return np.memmap(path, dtype=metadata['dtype'], mode=mode, shape=shape), metadata
+
+
+def grow_od_store(table, regions, store_dir=od_store_dir_default, ids=None):
+    """
+    Adds new regions to a table store. The stored days are rewritten one
+    at a time to a new file, with NaN for the pairs of the new regions,
+    which then replaces the array.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        regions (list of str): MITMA codes of all the regions, starting
+            with the regions of the store in the same order
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+        ids (list of int, optional): id of each region in the regions
+            dictionary, required if the store has ids. Defaults to None.
+    """
+    path, metadata_path = od_store_paths(table, store_dir)
+    tensor, metadata = open_od_tensor(table, store_dir)
+    regions = [str(region) for region in regions]
+    n_old, n_new = len(metadata['regions']), len(regions)
+    if regions[:n_old] != metadata['regions']:
+        raise ValueError(f"Regions don't extend the regions of the {table} store")
+    if metadata.get('ids') is not None:
+        ids = None if ids is None else [int(i) for i in ids]
+        if (ids is None) or (len(ids) != n_new) or (ids[:n_old] != metadata['ids']):
+            raise ValueError(f"Ids don't extend the ids of the {table} store")
+
+    print(f"Adding {n_new - n_old} regions to the {table} store")
+    new_path = path + '.new'
+    with open(new_path, 'wb') as f:
+        f.truncate(len(metadata['days']) * n_new * n_new * np.dtype(metadata['dtype']).itemsize)
+    if metadata['days']:
+        grown = np.memmap(
+            new_path, dtype=metadata['dtype'], mode='r+', shape=(len(metadata['days']), n_new, n_new))
+        for i in range(len(metadata['days'])):
+            grown[i] = np.nan
+            grown[i, :n_old, :n_old] = tensor[i]
+        grown.flush()
+        del grown
+    del tensor
+    os.replace(new_path, path)
+
+    # Metadata is updated once the array is on disk
+    metadata['regions'] = regions
+    if metadata.get('ids') is not None:
+        metadata['ids'] = ids
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f)
+
+
+def append_od_day(table, day, df, store_dir=od_store_dir_default):
+    """
+    Appends the OD matrix of a day to a table store. If the day is
+    already stored, its matrix is replaced. Regions given as ids are
+    mapped to the array through the ids of the store, which grows to
+    include the regions of the dictionary that it doesn't have yet.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        day (str): day in format %Y-%m-%d
+        df (dataframe): rows of the day with source, target and the
+            value column of the table. Regions are their ids or MITMA
+            codes.
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+    """
+    path, metadata_path = od_store_paths(table, store_dir)
+    metadata = read_od_metadata(table, store_dir)
+
+    if pd.api.types.is_integer_dtype(df['source']) and pd.api.types.is_integer_dtype(df['target']):
+        if metadata.get('ids') is None:
+            raise ValueError(f"The {table} store has no region ids, regions must be MITMA codes")
+        index = pd.Index(metadata['ids'])
+        sources, targets = index.get_indexer(df['source'].values), index.get_indexer(df['target'].values)
+
+        # Regions added to the dictionary after the store was created
+        missing = np.union1d(df['source'].values[sources == -1], df['target'].values[targets == -1])
+        if len(missing):
+            df_regions = load_regions(reload=True)
+            df_regions = df_regions[df_regions['id'].isin(missing)]
+            if len(df_regions) < len(missing):
+                raise KeyError(f"Regions not in the regions dictionary for the {table} store")
+            grow_od_store(
+                table, metadata['regions'] + df_regions['code'].tolist(), store_dir,
+                metadata['ids'] + df_regions['id'].tolist())
+            metadata = read_od_metadata(table, store_dir)
+            index = pd.Index(metadata['ids'])
+            sources, targets = index.get_indexer(df['source'].values), index.get_indexer(df['target'].values)
+    else:
+        sources, targets = region_index(metadata, df['source']), region_index(metadata, df['target'])
+    n_regions = len(metadata['regions'])
+
+    # Matrix of the day
+    matrix = np.full((n_regions, n_regions), np.nan, dtype=metadata['dtype'])
+    matrix[sources, targets] = df[metadata['value']].values
+
+    if day in metadata['days']:
+        i = metadata['days'].index(day)
+    else:
+        # Grow the file by one matrix
+        i = len(metadata['days'])
+        with open(path, 'r+b') as f:
+            f.truncate((i + 1) * matrix.nbytes)
+
+    tensor = np.memmap(path, dtype=metadata['dtype'], mode='r+', shape=(i + 1, n_regions, n_regions))
+    tensor[i] = matrix
+    tensor.flush()
+    del tensor
+
+    # Metadata is updated once the matrix is on disk
+    if i == len(metadata['days']):
+        metadata['days'].append(day)
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+
+
+def update_od_store(table, date1=None, date2=None, store_dir=od_store_dir_default):
+    """
+    Appends to a table store the days of the table that it doesn't have
+    yet, one day per query. If the store doesn't exist, it is created
+    with all the regions of the dictionary, in the order of their ids.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults
+            to None, which starts at the first day.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults
+            to None, which ends at the last day.
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+    """
+    _, metadata_path = od_store_paths(table, store_dir)
+    if not os.path.exists(metadata_path):
+        df_regions = load_regions(reload=True)
+        create_od_store(table, df_regions['code'].tolist(), store_dir, df_regions['id'].tolist())
+
+    metadata = read_od_metadata(table, store_dir)
+
+    # Days of the table. Missing bounds are open
+    conditions = date_conditions(date1, date2)
+    query = f"SELECT DISTINCT datetime FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    parameters = {'date1': date1, 'date2': date2}
+    days = pd.to_datetime(query_dataframe(query + " ORDER BY datetime", parameters)['datetime'])
+
+    for day in days.dt.strftime('%Y-%m-%d'):
+        if day in metadata['days']:
+            continue
+
+        print(f"Storing {table} {day}")
+        df = query_dataframe(
+            f"SELECT source, target, {metadata['value']} FROM {table} WHERE datetime = %(day)s",
+            {'day': day})
+        append_od_day(table, day, df, store_dir)
+
+
+def od_days_between_dates(metadata, date1, date2):
+    """
+    Gets the positions of the stored days between two dates, to select
+    them in the array of open_od_tensor.
+
+    Args:
+        metadata (dict): store metadata from read_od_metadata
+        date1 (str): start date in format %Y-%m-%d
+        date2 (str): end date in format %Y-%m-%d
+
+    Returns:
+        array: positions of the days
+    """
+    days = np.asarray(metadata['days'])
+
+    return np.flatnonzero((days >= date1) & (days <= date2))
+
+
+def od_mean_between_dates(table, date1, date2, store_dir=od_store_dir_default):
+    """
+    Computes the mean OD matrix of the days between two dates. Days
+    without rows for a pair are not counted in its mean.
+
+    Args:
+        table (str): mitma_trips_matrix or mitma_flux
+        date1 (str): start date in format %Y-%m-%d
+        date2 (str): end date in format %Y-%m-%d
+        store_dir (str, optional): store folder. Defaults to
+            od_store_dir_default.
+
+    Returns:
+        array: (regions x regions) mean matrix, NaN for pairs without
+            rows
+    """
+    tensor, metadata = open_od_tensor(table, store_dir)
+    days = od_days_between_dates(metadata, date1, date2)
+
+    n_regions = len(metadata['regions'])
+    total = np.zeros((n_regions, n_regions), dtype=np.float64)
+    count = np.zeros((n_regions, n_regions), dtype=np.int64)
+
+    # One day at a time to keep memory bounded
+    for i in days:
+        matrix = tensor[i]
+        valid = ~np.isnan(matrix)
+        total[valid] += matrix[valid]
+        count += valid
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, total / count, np.nan)
@@ -0,0 +1,274 @@
+"""
+Functions to export the MITMA derived tables to a local cache of
+Parquet files partitioned by date, and to read them back filtering by
+date and by region. Regions are stored as their int32 ids of the
+regions dictionary. The date ranges of the completed exports are
+recorded, so reads outside them use the database.
+"""
+
+# Imports
+import os
+import json
+import shutil
+import uuid
+from datetime import date, timedelta
+from functools import reduce
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.database_utils import query_dataframe_chunks, date_conditions
+from src.regions import region_id_dtype, encode_regions, decode_regions, prefix_id_ranges
+
+# Cache folder
+cache_dir_default = 'data/processed/cache/'
+
+# Partitioning of the cached tables. One folder for each day
+date_partitioning = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+
+# Region columns of the tables
+region_columns = ['source', 'target']
+
+# Bounds of the open date ranges of the exports
+first_date_open = '0001-01-01'
+last_date_open = '9999-12-31'
+
+
+def shift_date(day, days):
+    """
+    Moves a date some days.
+
+    Args:
+        day (str): date in format %Y-%m-%d
+        days (int): number of days, negative to move backwards
+
+    Returns:
+        str: moved date in format %Y-%m-%d
+    """
+    return (date.fromisoformat(day) + timedelta(days=days)).isoformat()
+
+
+def read_cached_ranges(table, cache_dir=cache_dir_default):
+    """
+    Reads the date ranges of the completed exports of a table. Open
+    bounds are first_date_open and last_date_open.
+
+    Args:
+        table (str): name of the table
+        cache_dir (str, optional): cache folder. Defaults to
+            cache_dir_default.
+
+    Returns:
+        list of (str, str): first and last date of each range, sorted
+    """
+    path = os.path.join(cache_dir, table + '_dates.json')
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return [tuple(date_range) for date_range in json.load(f)]
+
+
+def write_cached_ranges(table, ranges, cache_dir=cache_dir_default):
+    """
+    Records the date ranges of the completed exports of a table,
+    merging the overlapping and consecutive ranges.
+
+    Args:
+        table (str): name of the table
+        ranges (list of (str, str)): first and last date of each range
+        cache_dir (str, optional): cache folder. Defaults to
+            cache_dir_default.
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and ((merged[-1][1] == last_date_open) or (first <= shift_date(merged[-1][1], 1))):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, table + '_dates.json'), 'w') as f:
+        json.dump(merged, f)
+
+
+def is_table_cached(table, cache_dir=cache_dir_default, date1=None, date2=None):
+    """
+    Checks if the days of a table between two dates are in the cache,
+    i.e. a completed export includes all of them.
+
+    Args:
+        table (str): name of the table
+        cache_dir (str, optional): cache folder. Defaults to
+            cache_dir_default.
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults
+            to None, which needs an export from the first day.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults
+            to None, which needs an export until the last day.
+
+    Returns:
+        bool: True if the days are cached
+    """
+    date1 = first_date_open if date1 is None else date1
+    date2 = last_date_open if date2 is None else date2
+
+    return os.path.isdir(os.path.join(cache_dir, table)) and any(
+        (first <= date1) and (date2 <= last) for first, last in read_cached_ranges(table, cache_dir))
+
+
+def export_table_to_parquet(
+    table, date1=None, date2=None, cache_dir=cache_dir_default, itersize=500_000):
+    """
+    Exports a table to Parquet files partitioned by date. The rows are
+    streamed from the database in chunks, and the days already cached
+    between date1 and date2 are replaced. The date range is recorded as
+    cached once the export is completed.
+
+    Args:
+        table (str): mitma_trips, mitma_trips_matrix, mitma_qrp or
+            mitma_flux
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults
+            to None, which exports from the first day.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults
+            to None, which exports until the last day.
+        cache_dir (str, optional): cache folder. Defaults to
+            cache_dir_default.
+        itersize (int, optional): rows of each chunk. Defaults to 500_000.
+    """
+    table_dir = os.path.join(cache_dir, table)
+    first = first_date_open if date1 is None else date1
+    last = last_date_open if date2 is None else date2
+
+    # The days to export aren't cached until the export is completed
+    ranges = []
+    for cached_first, cached_last in read_cached_ranges(table, cache_dir):
+        if (cached_last < first) or (cached_first > last):
+            ranges.append((cached_first, cached_last))
+            continue
+        if cached_first < first:
+            ranges.append((cached_first, shift_date(first, -1)))
+        if cached_last > last:
+            ranges.append((shift_date(last, 1), cached_last))
+    write_cached_ranges(table, ranges, cache_dir)
+
+    # Remove the days to export
+    if (date1 is None) and (date2 is None):
+        shutil.rmtree(table_dir, ignore_errors=True)
+    elif os.path.isdir(table_dir):
+        for partition in os.listdir(table_dir):
+            date = partition.split('=')[-1]
+            if ((date1 is None) or (date >= date1)) and ((date2 is None) or (date <= date2)):
+                shutil.rmtree(os.path.join(table_dir, partition))
+
+    # Missing bounds are open
+    conditions = date_conditions(date1, date2)
+    query = f"SELECT * FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    parameters = {'date1': date1, 'date2': date2}
+
+    print(f"Exporting {table} to {table_dir}")
+    for chunk in query_dataframe_chunks(query, parameters, itersize):
+        chunk = chunk.drop(columns=['parameter_id'])
+        chunk['date'] = chunk['datetime'].dt.strftime('%Y-%m-%d')
+
+        # Region ids
+        for column in region_columns:
+            if column in chunk.columns:
+                chunk[column] = chunk[column].astype(region_id_dtype)
+        df_table = pa.Table.from_pandas(chunk, preserve_index=False)
+
+        pq.write_to_dataset(
+            df_table, table_dir, partitioning=date_partitioning,
+            basename_template=uuid.uuid4().hex + '-{i}.parquet',
+            existing_data_behavior='overwrite_or_ignore')
+
+    write_cached_ranges(table, ranges + [(first, last)], cache_dir)
+
+
+def location_expression(codes, is_prefix, match_all, columns=('source', 'target')):
+    """
+    Builds a dataset filter on the region columns. Prefixes are
+    filtered as id ranges.
+
+    Args:
+        codes (list of str): MITMA codes or code prefixes
+        is_prefix (bool): True if codes are prefixes of the MITMA codes
+        match_all (bool): True if all the columns must match, otherwise
+            any of them
+        columns (tuple of str, optional): region columns to filter.
+            Defaults to ('source', 'target').
+
+    Returns:
+        pyarrow expression: filter on the region columns
+    """
+    if is_prefix:
+        ranges = prefix_id_ranges(codes)
+    else:
+        ids = encode_regions(codes, strict=False)
+
+    expressions = []
+    for column in columns:
+        field = pc.field(column)
+        if is_prefix:
+            expressions.append(reduce(
+                lambda a, b: a | b, [(field >= first) & (field <= last) for first, last in ranges],
+                pc.scalar(False)))
+        else:
+            expressions.append(field.isin(ids))
+
+    if match_all:
+        return reduce(lambda a, b: a & b, expressions)
+    return reduce(lambda a, b: a | b, expressions)
+
+
+def read_table_from_parquet(
+    table, date1=None, date2=None, regions=None, location=None,
+    cache_dir=cache_dir_default, decode=True):
+    """
+    Reads a cached table. Days outside date1 and date2 are not read and
+    the region filters are pushed down to the Parquet scan.
+
+    Args:
+        table (str): mitma_trips, mitma_trips_matrix, mitma_qrp or
+            mitma_flux
+        date1 (str, optional): start date in format %Y-%m-%d. Defaults
+            to None.
+        date2 (str, optional): end date in format %Y-%m-%d. Defaults
+            to None.
+        regions (list of str, optional): source regions to read.
+            Defaults to None.
+        location (pyarrow expression, optional): filter on the region
+            columns from location_expression. Defaults to None.
+        cache_dir (str, optional): cache folder. Defaults to
+            cache_dir_default.
+        decode (bool, optional): False to keep the region ids instead of
+            their MITMA codes, e.g. to build graphs. Defaults to True.
+
+    Returns:
+        dataframe: cached rows
+    """
+    dataset = ds.dataset(
+        os.path.join(cache_dir, table), format='parquet', partitioning=date_partitioning)
+
+    expression = pc.scalar(True)
+    if date1 is not None:
+        expression = expression & (pc.field('date') >= date1)
+    if date2 is not None:
+        expression = expression & (pc.field('date') <= date2)
+    if regions is not None:
+        expression = expression & pc.field('source').isin(encode_regions(regions, strict=False))
+    if location is not None:
+        expression = expression & location
+
+    columns = [name for name in dataset.schema.names if name != 'date']
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    if decode:
+        for column in region_columns:
+            if column in df.columns:
+                df[column] = decode_regions(df[column].values)
+
+    return df
@@ -0,0 +1,121 @@
+"""
+Functions to use the dictionary of MITMA regions, which gives each MITMA
+code a stable int32 id (mitma_regions table). Regions are stored and
+joined by id and decoded to their codes only for display. Ids follow
+the order of the codes within each load, so the regions of a province
+or a municipality are a few id ranges.
+"""
+
+# Imports
+import numpy as np
+import pandas as pd
+
+from src.database_utils import query_dataframe
+
+# Type of the region ids
+region_id_dtype = np.int32
+
+# Dictionary loaded in this process
+_regions = {}
+
+
+def load_regions(reload=False):
+    """
+    Loads the regions dictionary. It is kept in memory once loaded.
+
+    Args:
+        reload (bool, optional): True to read the dictionary again, e.g.
+            after other processes add regions. Defaults to False.
+
+    Returns:
+        dataframe: with the id, code, province and municipality of each
+            region, in the order of the ids
+    """
+    if reload or ('regions' not in _regions):
+        df = query_dataframe(
+            "SELECT id, code, province, municipality FROM mitma_regions ORDER BY id")
+        df['id'] = df['id'].astype(region_id_dtype)
+
+        # Codes in code order, for the prefix lookups
+        order = np.argsort(df['code'].values, kind='stable')
+        _regions['regions'] = df
+        _regions['index'] = pd.Index(df['code'].values)
+        _regions['sorted_codes'] = df['code'].values[order]
+        _regions['sorted_ids'] = df['id'].values[order]
+
+    return _regions['regions']
+
+
+def encode_regions(codes, strict=True):
+    """
+    Gets the ids of MITMA codes.
+
+    Args:
+        codes (list of str): MITMA codes
+        strict (bool, optional): False to skip the codes that aren't in
+            the dictionary instead of raising a KeyError. Defaults to
+            True.
+
+    Returns:
+        array: int32 id of each code
+    """
+    load_regions()
+    ids = _regions['index'].get_indexer(np.asarray(codes, dtype=object))
+    if not strict:
+        ids = ids[ids != -1]
+    elif (ids == -1).any():
+        missing = pd.unique(np.asarray(codes, dtype=object)[ids == -1])
+        raise KeyError(f"Regions not in the regions dictionary: {list(missing[:10])}")
+
+    return ids.astype(region_id_dtype)
+
+
+def decode_regions(ids):
+    """
+    Gets the MITMA codes of region ids.
+
+    Args:
+        ids (array): region ids
+
+    Returns:
+        categorical: MITMA code of each id, with all the codes of the
+            dictionary as categories
+    """
+    ids = np.asarray(ids)
+    df = load_regions()
+    if len(ids) and (ids.max() >= len(df)):
+        # Regions added since the dictionary was loaded
+        df = load_regions(reload=True)
+
+    return pd.Categorical.from_codes(ids, categories=df['code'].values)
+
+
+def prefix_id_ranges(prefixes):
+    """
+    Gets the id ranges of the regions whose codes start with some
+    prefixes, e.g. province or municipality codes.
+
+    Args:
+        prefixes (list of str): MITMA code prefixes
+
+    Returns:
+        list of (int, int): first and last id of each range
+    """
+    load_regions()
+    sorted_codes, sorted_ids = _regions['sorted_codes'], _regions['sorted_ids']
+
+    ids = []
+    for prefix in prefixes:
+        # Codes with the prefix are contiguous in code order
+        first = np.searchsorted(sorted_codes, prefix, side='left')
+        last = np.searchsorted(sorted_codes, prefix + '\uffff', side='left')
+        ids.append(sorted_ids[first:last])
+    ids = np.unique(np.concatenate(ids)) if ids else np.array([], dtype=region_id_dtype)
+
+    # Consecutive ids in a single range
+    breaks = np.flatnonzero(np.diff(ids) != 1)
+    firsts = np.concatenate([ids[:1], ids[breaks + 1]])
+    lasts = np.concatenate([ids[breaks], ids[-1:]])
+
+    return [(int(first), int(last)) for first, last in zip(firsts, lasts)]
+
@@ -0,0 +1,223 @@
+"""
+Functions to load the MITMA districts zoning. The shapefile is parsed
+once and cached as GeoParquet with the centroid of each region, and the
+loaded zoning is kept in memory with its spatial index. Also, functions
+to compute and cache the distances between the region centroids.
+"""
+
+# Imports
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+# Paths
+zoning_shapefile_default = '../../data_1TB/MITMA/zonificación/distritos_mitma.shp'
+zoning_cache_default = 'data/processed/zoning/distritos_mitma.parquet'
+
+# Zonings loaded in this process, by cache path
+_zonings = {}
+
+# Distance bins (km) of the graph notebooks. Bins include their upper
+# limit
+distance_bins = [0, 10, 50, 200, 600]
+distance_labels = ['<10', '10-50', '50-200', '200-600']
+
+# Mean Earth radius (km)
+earth_radius = 6371.0088
+
+
+def load_zoning(shapefile=zoning_shapefile_default, cache_path=zoning_cache_default):
+    """
+    Loads the MITMA zoning with the geometry and the centroid of each
+    region. The GeoParquet cache is created from the shapefile the first
+    time, or when the shapefile is newer. The spatial index is built
+    when the zoning is loaded.
+
+    Args:
+        shapefile (str, optional): path of the zoning shapefile. Defaults
+            to zoning_shapefile_default.
+        cache_path (str, optional): path of the GeoParquet cache.
+            Defaults to zoning_cache_default.
+
+    Returns:
+        geodataframe: with ID, geometry and centroid columns
+    """
+    if cache_path in _zonings:
+        return _zonings[cache_path]
+
+    if os.path.exists(cache_path) and (
+            not os.path.exists(shapefile) or os.path.getmtime(cache_path) >= os.path.getmtime(shapefile)):
+        gdf = gpd.read_parquet(cache_path)
+    else:
+        print(f"Caching {shapefile} in {cache_path}")
+        gdf = gpd.read_file(shapefile)
+        gdf['ID'] = gdf['ID'].astype(str)
+        gdf['centroid'] = gdf['geometry'].centroid
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        gdf.to_parquet(cache_path, index=False)
+
+    # Build the spatial index once
+    gdf.sindex
+    _zonings[cache_path] = gdf
+
+    return gdf
+
+
+def zoning_regions(regions=None, provinces=None, shapefile=zoning_shapefile_default,
+                   cache_path=zoning_cache_default):
+    """
+    Gets the zoning of some MITMA regions, keeping the zoning order.
+
+    Args:
+        regions (list of str, optional): MITMA codes of the regions.
+            Defaults to None.
+        provinces (list of str, optional): province codes (first two
+            digits of the MITMA codes). Defaults to None.
+        shapefile (str, optional): path of the zoning shapefile. Defaults
+            to zoning_shapefile_default.
+        cache_path (str, optional): path of the GeoParquet cache.
+            Defaults to zoning_cache_default.
+
+    Returns:
+        geodataframe: with ID, geometry and centroid columns of the
+            regions in regions and in provinces. All of them if both
+            are None.
+    """
+    gdf = load_zoning(shapefile, cache_path)
+
+    if (regions is None) and (provinces is None):
+        return gdf
+
+    mask = False
+    if regions is not None:
+        mask = gdf['ID'].isin([str(region) for region in regions])
+    if provinces is not None:
+        mask = mask | gdf['ID'].str[:2].isin(list(provinces))
+
+    return gdf[mask]
+
+
+def compute_centroid_distances(gdf, method='haversine'):
+    """
+    Computes the distance in km between the centroids of all the pairs
+    of regions with NumPy broadcasting.
+
+    Args:
+        gdf (geodataframe): zoning with a centroid column
+        method (str, optional): 'haversine' for great-circle distances
+            or 'projected' for euclidean distances in the projected CRS
+            of the zoning (in metres). Defaults to 'haversine'.
+
+    Returns:
+        array: (regions x regions) float32 distances in km
+    """
+    centroids = gpd.GeoSeries(gdf['centroid'], crs=gdf.crs)
+
+    if method == 'projected':
+        if not centroids.crs.is_projected:
+            raise ValueError(f'The zoning CRS {centroids.crs} is not projected')
+        x, y = centroids.x.values, centroids.y.values
+        distances = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :]) / 1000
+
+    elif method == 'haversine':
+        centroids = centroids.to_crs('EPSG:4326')
+        lon, lat = np.radians(centroids.x.values), np.radians(centroids.y.values)
+        a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2 +
+             np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2)
+        distances = 2 * earth_radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    else:
+        raise ValueError(f'Unknown distance method {method}')
+
+    return distances.astype(np.float32)
+
+
+def load_centroid_distances(regions=None, method='haversine', shapefile=zoning_shapefile_default,
+                            cache_path=zoning_cache_default):
+    """
+    Loads the distance matrix between the region centroids. The matrix
+    of all the zoning regions is cached as .npy next to the zoning
+    cache, and it is recomputed when the zoning cache is newer.
+
+    Args:
+        regions (list of str, optional): MITMA codes of the rows and
+            columns of the matrix. Defaults to None, which returns all
+            the zoning regions.
+        method (str, optional): 'haversine' or 'projected'. Defaults to
+            'haversine'.
+        shapefile (str, optional): path of the zoning shapefile. Defaults
+            to zoning_shapefile_default.
+        cache_path (str, optional): path of the GeoParquet cache.
+            Defaults to zoning_cache_default.
+
+    Returns:
+        (array, array): MITMA codes and (regions x regions) distances in
+            km
+    """
+    gdf = load_zoning(shapefile, cache_path)
+    distances_path = os.path.join(os.path.dirname(cache_path), f'distances_{method}.npy')
+
+    if os.path.exists(distances_path) and (
+            os.path.getmtime(distances_path) >= os.path.getmtime(cache_path)):
+        distances = np.load(distances_path, mmap_mode='r')
+    else:
+        print(f"Caching centroid distances in {distances_path}")
+        distances = compute_centroid_distances(gdf, method)
+        np.save(distances_path, distances)
+
+    codes = np.asarray(gdf['ID'], dtype=object)
+    if regions is None:
+        return codes, np.asarray(distances)
+
+    ids = pd.Index(codes).get_indexer([str(region) for region in regions])
+    if (ids == -1).any():
+        raise KeyError('Regions not in the zoning')
+
+    return codes[ids], distances[np.ix_(ids, ids)]
+
+
+def bin_distances(distances, bins=distance_bins):
+    """
+    Bins distances as pd.cut does with right closed bins, as compact
+    int8 codes.
+
+    Args:
+        distances (array): distances in km
+        bins (list of float, optional): bin limits. Defaults to
+            distance_bins.
+
+    Returns:
+        array: int8 bin of each distance, -1 if it is out of the bins
+    """
+    codes = np.searchsorted(bins, distances, side='left') - 1
+    codes[(codes < 0) | (codes >= len(bins) - 1)] = -1
+
+    return codes.astype(np.int8)
+
+
+def distances_to_dataframe(regions, distances, bins=distance_bins, labels=distance_labels):
+    """
+    Builds the long dataframe of the distances between regions used by
+    the graph notebooks.
+
+    Args:
+        regions (array): MITMA codes of the rows and columns of distances
+        distances (array): (regions x regions) distances in km
+        bins (list of float, optional): bin limits. Defaults to
+            distance_bins.
+        labels (list of str, optional): bin labels. Defaults to
+            distance_labels.
+
+    Returns:
+        dataframe: with source, target, geo_distance and the categorical
+            geo_distance_b columns
+    """
+    n_regions = len(regions)
+    codes = bin_distances(np.asarray(distances).ravel(), bins)
+
+    return pd.DataFrame({
+        'source': np.repeat(regions, n_regions), 'target': np.tile(regions, n_regions),
+        'geo_distance': np.asarray(distances).ravel(),
+        'geo_distance_b': pd.Categorical.from_codes(codes, categories=labels)})